@@ -4,16 +4,27 @@ from fastapi import APIRouter
 from loguru import logger
 
 from .crud import db
-from .tasks import restart_address_tracking, wait_for_onchain, wait_for_paid_invoices
+from .http_clients import close_http_clients, start_http_clients
+from .notifications import restart_notification_task, stop_notification_task
+from .tasks import (
+    restart_address_tracking,
+    wait_for_expired_charges,
+    wait_for_onchain,
+    wait_for_paid_invoices,
+    wait_for_settings_changes,
+)
 from .views import satspay_generic_router
 from .views_api import satspay_api_router
 from .views_api_themes import satspay_theme_router
+from .views_api_webhooks import satspay_webhook_router
+from .webhooks import WEBHOOK_WORKERS, dispatch_webhooks, webhook_worker
 from .websocket_handler import restart_websocket_task, websocket_task
 
 satspay_ext: APIRouter = APIRouter(prefix="/satspay", tags=["satspay"])
 satspay_ext.include_router(satspay_generic_router)
 satspay_ext.include_router(satspay_api_router)
 satspay_ext.include_router(satspay_theme_router)
+satspay_ext.include_router(satspay_webhook_router)
 
 satspay_static_files = [
     {
@@ -33,6 +44,11 @@ def satspay_stop():
             logger.warning(ex)
     if websocket_task:
         websocket_task.cancel()
+    stop_notification_task()
+
+    from lnbits.tasks import create_unique_task
+
+    create_unique_task("ext_satspay_close_http_clients", close_http_clients())
 
 
 def satspay_start():
@@ -42,8 +58,27 @@ def satspay_start():
         "ext_satspay_paid_invoices", wait_for_paid_invoices
     )
     onchain_task = create_permanent_unique_task("ext_satspay_onchain", wait_for_onchain)
-    scheduled_tasks.extend([paid_invoices_task, onchain_task])
+    expiry_task = create_permanent_unique_task(
+        "ext_satspay_expiry", wait_for_expired_charges
+    )
+    settings_task = create_permanent_unique_task(
+        "ext_satspay_settings", wait_for_settings_changes
+    )
+    scheduled_tasks.extend(
+        [paid_invoices_task, onchain_task, expiry_task, settings_task]
+    )
+    scheduled_tasks.append(
+        create_permanent_unique_task("ext_satspay_webhook_outbox", dispatch_webhooks)
+    )
+    for i in range(WEBHOOK_WORKERS):
+        scheduled_tasks.append(
+            create_permanent_unique_task(
+                f"ext_satspay_webhook_worker_{i}", webhook_worker
+            )
+        )
+    create_unique_task("ext_satspay_http_clients", start_http_clients())
     restart_websocket_task()
+    restart_notification_task()
     create_unique_task(
         "ext_satspay_restart_address_tracking", restart_address_tracking()
     )
@@ -0,0 +1,57 @@
+from lnbits.tasks import create_unique_task
+from loguru import logger
+
+from .crud import add_pooled_address, claim_pooled_address, count_pooled_addresses
+from .helpers import fetch_onchain_address
+
+# kept small, every pooled address counts against the wallet's gap limit
+ADDRESS_POOL_SIZE = 10
+ADDRESS_POOL_LOW_WATER = 3
+
+
+class AddressPool:
+    """
+    Fresh onchain addresses per (watchonly wallet, user), handed out to new
+    charges and refilled in the background once the pool runs low.
+    """
+
+    def __init__(
+        self, size: int = ADDRESS_POOL_SIZE, low_water: int = ADDRESS_POOL_LOW_WATER
+    ):
+        self.size = size
+        self.low_water = low_water
+        self._refilling: set[tuple[str, str]] = set()
+
+    async def take(self, wallet_id: str, user: str, api_key: str) -> str:
+        address = await claim_pooled_address(wallet_id, user)
+        if not address:
+            address = await fetch_onchain_address(wallet_id, api_key)
+        self.refill(wallet_id, user, api_key)
+        return address
+
+    def refill(self, wallet_id: str, user: str, api_key: str) -> None:
+        key = (wallet_id, user)
+        if key in self._refilling:
+            return
+        self._refilling.add(key)
+        create_unique_task(
+            f"ext_satspay_address_pool_{wallet_id}_{user}",
+            self._refill(wallet_id, user, api_key),
+        )
+
+    async def _refill(self, wallet_id: str, user: str, api_key: str) -> None:
+        try:
+            count = await count_pooled_addresses(wallet_id, user)
+            if count >= self.low_water:
+                return
+            for _ in range(self.size - count):
+                address = await fetch_onchain_address(wallet_id, api_key)
+                await add_pooled_address(wallet_id, user, address)
+            logger.debug(f"Refilled address pool of wallet {wallet_id}.")
+        except Exception as exc:
+            logger.warning(f"Refilling address pool of {wallet_id} failed: {exc!s}")
+        finally:
+            self._refilling.discard((wallet_id, user))
+
+
+address_pool = AddressPool()
@@ -0,0 +1,218 @@
+import asyncio
+from collections.abc import Iterable
+from typing import Optional
+
+from loguru import logger
+
+
+class AddressSubscription:
+    """
+    Addresses tracked on one mempool websocket connection.
+
+    mempool replaces the tracked set with every `track-addresses` frame, so a frame
+    always carries the full set of this connection. What is kept here is the diff
+    against the last frame that was sent, so bursts of track/untrack calls collapse
+    into one frame and changes that cancel each other out are never sent.
+    """
+
+    def __init__(self, name: str, capacity: Optional[int] = None):
+        self.name = name
+        self.capacity = capacity
+        self.alive = True
+        self.addresses: set[str] = set()
+        self._added: set[str] = set()
+        self._removed: set[str] = set()
+        self._changed = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self.addresses)
+
+    def __contains__(self, address: object) -> bool:
+        return address in self.addresses
+
+    @property
+    def has_changes(self) -> bool:
+        return bool(self._added or self._removed)
+
+    @property
+    def has_room(self) -> bool:
+        return self.capacity is None or len(self.addresses) < self.capacity
+
+    def add(self, address: str) -> None:
+        self.addresses.add(address)
+        if address in self._removed:
+            self._removed.discard(address)
+        else:
+            self._added.add(address)
+        self._changed.set()
+
+    def remove(self, address: str) -> None:
+        self.addresses.discard(address)
+        if address in self._added:
+            self._added.discard(address)
+        else:
+            self._removed.add(address)
+        self._changed.set()
+
+    def resync(self) -> None:
+        """
+        Forget what was sent before, e.g. after a reconnect the upstream
+        does not know about any of our addresses anymore.
+        """
+        self._added = set(self.addresses)
+        self._removed.clear()
+        self._changed.set()
+
+    async def next_frame(self) -> list[str]:
+        """
+        Wait until the subscribed set differs from the last frame and return
+        the addresses that should be sent upstream.
+        """
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            if self.has_changes:
+                break
+        self._added.clear()
+        self._removed.clear()
+        return list(self.addresses)
+
+
+class AddressRegistry:
+    """
+    All onchain addresses we are listening on, with O(1) track/untrack.
+
+    Addresses are spread over a number of shards, one per websocket connection,
+    preferring live shards with fewer than `capacity` addresses. When all shards
+    are full the least loaded one takes the address anyway, an address that is
+    not subscribed anywhere would mean missed payments. The addresses of a shard
+    that goes down move to the live ones and are spread again once it is back.
+    """
+
+    def __init__(self, shards: int = 1, capacity: Optional[int] = None):
+        self.shards: list[AddressSubscription] = []
+        self._owner: dict[str, AddressSubscription] = {}
+        self.configure(shards, capacity)
+
+    def __len__(self) -> int:
+        return len(self._owner)
+
+    def __contains__(self, address: object) -> bool:
+        return address in self._owner
+
+    @property
+    def over_capacity(self) -> int:
+        return sum(
+            len(shard) - shard.capacity
+            for shard in self.shards
+            if shard.capacity is not None and len(shard) > shard.capacity
+        )
+
+    def configure(self, shards: int, capacity: Optional[int] = None) -> None:
+        """
+        (Re)create the shards and spread all tracked addresses over them.
+        """
+        shards = max(1, shards)
+        if len(self.shards) == shards and all(
+            shard.capacity == capacity for shard in self.shards
+        ):
+            return
+        addresses = list(self._owner)
+        self.shards = [
+            AddressSubscription(f"mempool-{i}", capacity) for i in range(shards)
+        ]
+        self._owner.clear()
+        for address in addresses:
+            self._place(address)
+
+    def track(self, address: str) -> bool:
+        if address in self:
+            return False
+        self._place(address)
+        return True
+
+    def track_many(self, addresses: Iterable[str]) -> int:
+        return sum(1 for address in addresses if self.track(address))
+
+    def untrack(self, address: str) -> bool:
+        shard = self._owner.pop(address, None)
+        if shard is None:
+            return False
+        shard.remove(address)
+        return True
+
+    def mark_alive(self, shard: AddressSubscription) -> None:
+        """
+        Give a shard that reconnected the addresses left on dead shards and its
+        share of the addresses of the other live shards.
+        """
+        if shard.alive:
+            return
+        shard.alive = True
+        others = [other for other in self.shards if other is not shard]
+        moved = 0
+        for other in others:
+            if not other.alive:
+                for address in list(other.addresses):
+                    self._move(address, other, shard)
+                    moved += 1
+        live = [other for other in others if other.alive]
+        share = len(self) // (len(live) + 1)
+        while live and len(shard) < share and shard.has_room:
+            source = max(live, key=len)
+            if len(source) <= share:
+                break
+            self._move(next(iter(source.addresses)), source, shard)
+            moved += 1
+        logger.info(f"Websocket shard {shard.name} is back, moved {moved} addresses.")
+
+    def mark_dead(self, shard: AddressSubscription) -> None:
+        """
+        Move the addresses of a dead shard to the remaining live shards,
+        they stay with the dead shard only if no shard is alive.
+        """
+        if not shard.alive:
+            return
+        shard.alive = False
+        moved = 0
+        for address in list(shard.addresses):
+            target = self._pick_shard(alive_only=True)
+            if target is None:
+                break
+            self._move(address, shard, target)
+            moved += 1
+        logger.warning(
+            f"Websocket shard {shard.name} is down, "
+            f"moved {moved} addresses, {len(shard)} left behind."
+        )
+
+    def _place(self, address: str) -> None:
+        shard = self._pick_shard(alive_only=True)
+        if shard is None:
+            shard = self._pick_shard()
+        if shard is None:
+            raise ValueError("The address registry has no websocket shards.")
+        if shard.capacity is not None and len(shard) == shard.capacity:
+            logger.warning(
+                f"All websocket shards are full, {shard.name} goes above capacity. "
+                "Consider more shards or a higher capacity."
+            )
+        shard.add(address)
+        self._owner[address] = shard
+
+    def _move(
+        self, address: str, source: AddressSubscription, target: AddressSubscription
+    ) -> None:
+        source.remove(address)
+        target.add(address)
+        self._owner[address] = target
+
+    def _pick_shard(self, alive_only: bool = False) -> Optional[AddressSubscription]:
+        candidates = [shard for shard in self.shards if shard.alive or not alive_only]
+        if not candidates:
+            return None
+        with_room = [shard for shard in candidates if shard.has_room]
+        return min(with_room or candidates, key=len)
+
+
+address_registry = AddressRegistry()
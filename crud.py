@@ -1,25 +1,48 @@
+import asyncio
+import time
 from datetime import datetime
-from typing import Optional
+from typing import Optional, Union
+from urllib.parse import urlparse
 
 from lnbits.core.services import create_invoice
-from lnbits.db import Database
+from lnbits.db import SQLITE, Connection, Database
 from lnbits.helpers import urlsafe_short_hash
 
+from .cache import LRUCache
 from .models import (
     Charge,
+    ChargeNotification,
+    ChargesPage,
+    ChargeSummary,
+    ChargeTransaction,
     CreateCharge,
     CreateSatsPayTheme,
+    FiatRate,
+    OnchainTransaction,
     SatspaySettings,
     SatsPayTheme,
+    WebhookDelivery,
 )
+from .stylesheets import theme_stylesheets
 
 db = Database("ext_satspay")
 
+# public checkout pages and status polls are served from here, every write of a
+# charge goes through `update_charge(_state)`/`delete_charge` which keep it current
+charge_cache: LRUCache[str, Charge] = LRUCache(maxsize=2000, ttl=30)
 
-async def create_charge(
+# other workers only see updated settings once their cached copy runs out
+SETTINGS_CACHE_TTL = 30
+_settings_cache: Optional[SatspaySettings] = None
+_settings_cached_at = 0.0
+_settings_lock = asyncio.Lock()
+
+
+async def _new_charge(
     user: str,
     data: CreateCharge,
     onchainaddress: Optional[str] = None,
+    fiat_rate: Optional[FiatRate] = None,
 ) -> Charge:
     if not data.amount or data.amount <= 0:
         raise Exception("Amount must be greater than 0")
@@ -49,6 +72,8 @@ async def create_charge(
         custom_css=data.custom_css,
         currency=data.currency,
         currency_amount=data.currency_amount,
+        fiat_rate=fiat_rate.rate if fiat_rate else None,
+        fiat_rate_timestamp=fiat_rate.timestamp if fiat_rate else None,
     )
 
     if data.onchainwallet:
@@ -65,15 +90,131 @@ async def create_charge(
         )
         charge.payment_hash = payment.payment_hash
         charge.payment_request = payment.bolt11
+    return charge
+
+
+async def create_charge(
+    user: str,
+    data: CreateCharge,
+    onchainaddress: Optional[str] = None,
+    fiat_rate: Optional[FiatRate] = None,
+) -> Charge:
+    charge = await _new_charge(user, data, onchainaddress, fiat_rate)
     await db.insert("satspay.charges", charge)
     return charge
 
 
+async def create_charges(
+    user: str,
+    charges_data: list[tuple[CreateCharge, Optional[str], Optional[FiatRate]]],
+    concurrency: int = 10,
+) -> list[Union[Charge, Exception]]:
+    """
+    Create many charges from (data, onchainaddress, fiat_rate). Invoices are created
+    concurrently and the charges whose invoice was created are inserted in one
+    transaction. Returns the charge or the error of every item, in order.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def _create(
+        data: CreateCharge,
+        onchainaddress: Optional[str],
+        fiat_rate: Optional[FiatRate],
+    ) -> Charge:
+        async with semaphore:
+            return await _new_charge(user, data, onchainaddress, fiat_rate)
+
+    # a failed invoice must not orphan the invoices of the other charges
+    results = await asyncio.gather(
+        *[_create(*charge_data) for charge_data in charges_data],
+        return_exceptions=True,
+    )
+    charges: list[Union[Charge, Exception]] = []
+    for result in results:
+        if isinstance(result, BaseException) and not isinstance(result, Exception):
+            raise result
+        charges.append(result)
+    async with db.connect() as conn:
+        for charge in charges:
+            if isinstance(charge, Charge):
+                await conn.insert("satspay.charges", charge)
+    return charges
+
+
 async def update_charge(charge: Charge) -> Charge:
+    charge.version += 1
     await db.update("satspay.charges", charge)
+    charge.mark_persisted()
+    charge_cache.set(charge.id, charge.copy(deep=True))
     return charge
 
 
+async def _write_charge_state(
+    charge: Charge, conn: Optional[Connection] = None
+) -> bool:
+    result = await (conn or db).execute(
+        """
+        UPDATE satspay.charges
+        SET balance = :balance, pending = :pending, paid = :paid,
+        expired = :expired, extra = :extra, version = version + 1
+        WHERE id = :id AND version = :version
+        """,
+        {
+            "id": charge.id,
+            "version": charge.version,
+            "balance": charge.balance,
+            "pending": charge.pending,
+            "paid": charge.paid,
+            "expired": charge.expired,
+            "extra": charge.serialize_extra(),
+        },
+    )
+    return bool(result.rowcount)
+
+
+def _charge_state_written(charge: Charge) -> None:
+    charge.version += 1
+    charge.mark_persisted()
+    charge_cache.set(charge.id, charge.copy(deep=True))
+
+
+async def update_charge_state(charge: Charge, retries: int = 5) -> Charge:
+    """
+    Write only the payment state columns, guarded by the version the charge was
+    loaded with. If another writer came first the charge is rebased onto the
+    latest row and written again, so concurrent updates never lose `extra` keys.
+    """
+    for _ in range(retries):
+        if await _write_charge_state(charge):
+            _charge_state_written(charge)
+            return charge
+        latest = await get_charge(charge.id)
+        if not latest:
+            raise ValueError(f"Charge `{charge.id}` does not exist.")
+        charge.rebase(latest)
+    raise ValueError(f"Charge `{charge.id}` is updated concurrently, giving up.")
+
+
+async def update_charges_state(charges: list[Charge]) -> list[Charge]:
+    """
+    Like `update_charge_state` for many charges, written in one transaction.
+    Charges that were changed concurrently are rebased and written afterwards.
+    """
+    written: list[Charge] = []
+    conflicts: list[Charge] = []
+    async with db.connect() as conn:
+        for charge in charges:
+            if await _write_charge_state(charge, conn):
+                written.append(charge)
+            else:
+                conflicts.append(charge)
+    for charge in written:
+        _charge_state_written(charge)
+    for charge in conflicts:
+        await update_charge_state(charge)
+    return charges
+
+
 async def get_charge(charge_id: str) -> Optional[Charge]:
     return await db.fetchone(
         "SELECT * FROM satspay.charges WHERE id = :id",
@@ -82,13 +223,60 @@ async def get_charge(charge_id: str) -> Optional[Charge]:
     )
 
 
-async def get_pending_charges() -> list[Charge]:
+async def get_charge_cached(charge_id: str) -> Optional[Charge]:
+    """
+    Read-only lookup for hot public endpoints, never mutate the returned charge.
+    """
+    charge = charge_cache.get(charge_id)
+    if charge:
+        return charge
+    charge = await get_charge(charge_id)
+    if charge:
+        charge_cache.set(charge_id, charge)
+    return charge
+
+
+def _charge_expiry() -> str:
+    # sqlite keeps timestamps as unix time, postgres as timestamps
+    if db.type == SQLITE:
+        return "timestamp + time * 60"
+    return "timestamp + time * INTERVAL '1 minute'"
+
+
+async def get_pending_charges(expires_after: float) -> list[Charge]:
+    """
+    Charges that are neither paid nor flagged as expired and expire after the
+    given unix time, expired charges are flagged by the expiry scheduler and by
+    `expire_overdue_charges` so this does not grow with the charge history.
+    """
     return await db.fetchall(
-        "SELECT * FROM satspay.charges WHERE paid = false",
-        model=Charge,
+        f"""
+        SELECT * FROM satspay.charges WHERE paid = false AND expired = false
+        AND {_charge_expiry()} > {db.timestamp_placeholder("expires_after")}
+        """,
+        {"expires_after": int(expires_after)},
+        Charge,
     )
 
 
+async def expire_overdue_charges(expired_before: float) -> int:
+    """
+    Flag unpaid charges that expired before the given unix time, e.g. while LNbits
+    was down, without loading them.
+    """
+    result = await db.execute(
+        f"""
+        UPDATE satspay.charges SET expired = true, version = version + 1
+        WHERE paid = false AND expired = false
+        AND {_charge_expiry()} <= {db.timestamp_placeholder("expired_before")}
+        """,
+        {"expired_before": int(expired_before)},
+    )
+    # only charges of the last minutes can be cached, but those could be stale
+    charge_cache.clear()
+    return result.rowcount
+
+
 async def get_charge_by_onchain_address(onchain_address: str) -> Optional[Charge]:
     return await db.fetchone(
         "SELECT * FROM satspay.charges WHERE onchainaddress = :address",
@@ -107,8 +295,187 @@ async def get_charges(user: str) -> list[Charge]:
     )
 
 
+async def get_unpaid_charges(
+    user: str,
+    charge_ids: Optional[list[str]] = None,
+    created_after: Optional[datetime] = None,
+    limit: int = 1000,
+) -> list[Charge]:
+    where = ['"user" = :user', "paid = false"]
+    values: dict = {"user": user, "limit": limit}
+    if charge_ids is not None:
+        ids = {f"id{n}": charge_id for n, charge_id in enumerate(charge_ids)}
+        where.append(f"id IN ({', '.join(f':{key}' for key in ids) or 'NULL'})")
+        values.update(ids)
+    if created_after:
+        where.append(f"timestamp >= {db.timestamp_placeholder('created_after')}")
+        values["created_after"] = int(created_after.timestamp())
+    return await db.fetchall(
+        f"""
+        SELECT * FROM satspay.charges WHERE {" AND ".join(where)}
+        ORDER BY timestamp DESC LIMIT :limit
+        """,
+        values,
+        Charge,
+    )
+
+
+def escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def encode_charges_cursor(charge: ChargeSummary) -> str:
+    return f"{charge.timestamp.timestamp():.6f}_{charge.id}"
+
+
+def decode_charges_cursor(cursor: str) -> tuple[float, str]:
+    timestamp, _, charge_id = cursor.partition("_")
+    if not charge_id:
+        raise ValueError("Invalid cursor.")
+    return float(timestamp), charge_id
+
+
+async def get_charges_paginated(
+    user: str,
+    limit: int = 50,
+    cursor: Optional[str] = None,
+    status: Optional[str] = None,
+    wallet: Optional[str] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    search: Optional[str] = None,
+) -> ChargesPage:
+    """
+    Newest charges first, keyset paginated on (timestamp, id). The cursor holds
+    both of the last charge of the previous page, see `encode_charges_cursor`.
+    """
+    where = ['"user" = :user']
+    values: dict = {"user": user, "limit": limit + 1}
+    if cursor:
+        cursor_timestamp, cursor_id = decode_charges_cursor(cursor)
+        cursor_ts = db.timestamp_placeholder("cursor_ts")
+        where.append(
+            f"""
+            (timestamp < {cursor_ts}
+            OR (timestamp = {cursor_ts} AND id < :cursor_id))
+            """
+        )
+        values["cursor_ts"] = cursor_timestamp
+        values["cursor_id"] = cursor_id
+    if status == "paid":
+        where.append("paid = true")
+    elif status == "pending":
+        where.append("paid = false AND expired = false")
+    elif status == "expired":
+        where.append("paid = false AND expired = true")
+    if wallet:
+        where.append("(lnbitswallet = :wallet OR onchainwallet = :wallet)")
+        values["wallet"] = wallet
+    if date_from:
+        where.append(f"timestamp >= {db.timestamp_placeholder('date_from')}")
+        values["date_from"] = int(date_from.timestamp())
+    if date_to:
+        where.append(f"timestamp < {db.timestamp_placeholder('date_to')}")
+        values["date_to"] = int(date_to.timestamp())
+    if search:
+        where.append(
+            "(LOWER(name) LIKE :search ESCAPE '\\' "
+            "OR LOWER(description) LIKE :search ESCAPE '\\')"
+        )
+        values["search"] = f"%{escape_like(search.lower())}%"
+    columns = ", ".join(f'"{column}"' for column in ChargeSummary.__fields__)
+    charges = await db.fetchall(
+        f"""
+        SELECT {columns} FROM satspay.charges WHERE {" AND ".join(where)}
+        ORDER BY timestamp DESC, id DESC LIMIT :limit
+        """,
+        values,
+        ChargeSummary,
+    )
+    next_cursor = (
+        encode_charges_cursor(charges[limit - 1]) if len(charges) > limit else None
+    )
+    return ChargesPage(data=charges[:limit], next_cursor=next_cursor)
+
+
 async def delete_charge(charge_id: str) -> None:
     await db.execute("DELETE FROM satspay.charges WHERE id = :id", {"id": charge_id})
+    await db.execute(
+        "DELETE FROM satspay.charge_transactions WHERE charge_id = :id",
+        {"id": charge_id},
+    )
+    await db.execute(
+        "DELETE FROM satspay.webhook_outbox WHERE charge_id = :id",
+        {"id": charge_id},
+    )
+    charge_cache.pop(charge_id)
+
+
+async def upsert_charge_transactions(
+    charge_id: str, address: str, transactions: list[OnchainTransaction]
+) -> None:
+    if not transactions:
+        return
+    async with db.connect() as conn:
+        for tx in transactions:
+            await conn.execute(
+                """
+                INSERT INTO satspay.charge_transactions
+                (charge_id, txid, address, value, status, block_height)
+                VALUES (:charge_id, :txid, :address, :value, :status, :block_height)
+                ON CONFLICT (charge_id, txid) DO UPDATE SET
+                value = excluded.value, status = excluded.status,
+                block_height = excluded.block_height
+                """,
+                {
+                    "charge_id": charge_id,
+                    "txid": tx.txid,
+                    "address": address,
+                    "value": tx.value,
+                    "status": "confirmed" if tx.confirmed else "mempool",
+                    "block_height": tx.block_height,
+                },
+            )
+
+
+async def delete_charge_transactions(charge_id: str, txids: list[str]) -> None:
+    for txid in txids:
+        await db.execute(
+            """
+            DELETE FROM satspay.charge_transactions
+            WHERE charge_id = :charge_id AND txid = :txid
+            """,
+            {"charge_id": charge_id, "txid": txid},
+        )
+
+
+async def get_charge_transactions(charge_id: str) -> list[ChargeTransaction]:
+    return await db.fetchall(
+        """
+        SELECT * FROM satspay.charge_transactions WHERE charge_id = :charge_id
+        ORDER BY created_at
+        """,
+        {"charge_id": charge_id},
+        ChargeTransaction,
+    )
+
+
+async def get_charge_transactions_by_txid(txid: str) -> list[ChargeTransaction]:
+    return await db.fetchall(
+        "SELECT * FROM satspay.charge_transactions WHERE txid = :txid",
+        {"txid": txid},
+        ChargeTransaction,
+    )
+
+
+async def set_settling_transaction(charge_id: str, txid: str) -> None:
+    await db.execute(
+        """
+        UPDATE satspay.charge_transactions SET settles_charge = true
+        WHERE charge_id = :charge_id AND txid = :txid
+        """,
+        {"charge_id": charge_id, "txid": txid},
+    )
 
 
 async def create_theme(data: CreateSatsPayTheme, user_id: str) -> SatsPayTheme:
@@ -124,6 +491,7 @@ async def create_theme(data: CreateSatsPayTheme, user_id: str) -> SatsPayTheme:
 
 async def update_theme(theme: SatsPayTheme) -> SatsPayTheme:
     await db.update("satspay.themes", theme, "css_id = :css_id")
+    theme_stylesheets.pop(theme.css_id)
     return theme
 
 
@@ -149,26 +517,250 @@ async def delete_theme(theme_id: str) -> None:
     await db.execute(
         "DELETE FROM satspay.themes WHERE css_id = :css_id", {"css_id": theme_id}
     )
+    theme_stylesheets.pop(theme_id)
 
 
-async def get_or_create_satspay_settings() -> SatspaySettings:
-    settings = await db.fetchone(
-        "SELECT * FROM satspay.settings LIMIT 1",
-        model=SatspaySettings,
+async def create_webhook_delivery(charge: Charge) -> WebhookDelivery:
+    assert charge.webhook, "Charge has no webhook."
+    now = datetime.now()
+    delivery = WebhookDelivery(
+        id=urlsafe_short_hash(),
+        charge_id=charge.id,
+        url=charge.webhook,
+        host=urlparse(charge.webhook).hostname or "",
+        payload=charge.json(),
+        created_at=now,
+        next_attempt_at=now,
     )
-    if settings:
-        return settings
-    else:
-        settings = SatspaySettings()
-        await db.insert("satspay.settings", settings)
+    await db.insert("satspay.webhook_outbox", delivery)
+    return delivery
+
+
+async def update_webhook_delivery(delivery: WebhookDelivery) -> WebhookDelivery:
+    await db.update("satspay.webhook_outbox", delivery)
+    return delivery
+
+
+async def get_webhook_delivery(delivery_id: str) -> Optional[WebhookDelivery]:
+    return await db.fetchone(
+        "SELECT * FROM satspay.webhook_outbox WHERE id = :id",
+        {"id": delivery_id},
+        WebhookDelivery,
+    )
+
+
+async def get_webhook_deliveries(
+    charge_id: Optional[str] = None,
+    status: Optional[str] = None,
+    limit: int = 100,
+) -> list[WebhookDelivery]:
+    where = []
+    values: dict = {"limit": limit}
+    if charge_id:
+        where.append("charge_id = :charge_id")
+        values["charge_id"] = charge_id
+    if status:
+        where.append("status = :status")
+        values["status"] = status
+    clause = f"WHERE {' AND '.join(where)}" if where else ""
+    return await db.fetchall(
+        f"""
+        SELECT * FROM satspay.webhook_outbox {clause}
+        ORDER BY created_at DESC LIMIT :limit
+        """,
+        values,
+        WebhookDelivery,
+    )
+
+
+async def get_due_webhook_deliveries(
+    limit: int = 100, exclude_hosts: Optional[list[str]] = None
+) -> list[WebhookDelivery]:
+    hosts = {f"host{n}": host for n, host in enumerate(exclude_hosts or [])}
+    host_clause = (
+        f"AND host NOT IN ({', '.join(f':{key}' for key in hosts)})" if hosts else ""
+    )
+    return await db.fetchall(
+        f"""
+        SELECT * FROM satspay.webhook_outbox
+        WHERE status = 'pending'
+        AND next_attempt_at <= {db.timestamp_placeholder("now")}
+        {host_clause}
+        ORDER BY next_attempt_at LIMIT :limit
+        """,
+        {"now": int(time.time()), "limit": limit, **hosts},
+        WebhookDelivery,
+    )
+
+
+async def claim_webhook_delivery(delivery_id: str, lease: int) -> bool:
+    """
+    Mark a due delivery as being sent by this worker for `lease` seconds. Only one
+    of the workers that try to claim the same delivery succeeds.
+    """
+    now = int(time.time())
+    result = await db.execute(
+        f"""
+        UPDATE satspay.webhook_outbox
+        SET status = 'sending',
+        claimed_until = {db.timestamp_placeholder("claimed_until")}
+        WHERE id = :id AND status = 'pending'
+        AND next_attempt_at <= {db.timestamp_placeholder("now")}
+        """,
+        {"id": delivery_id, "now": now, "claimed_until": now + lease},
+    )
+    return bool(result.rowcount)
+
+
+async def release_expired_webhook_claims() -> None:
+    """
+    Hand deliveries back to all workers when the worker that claimed them did not
+    finish them in time, e.g. because it was stopped while sending.
+    """
+    await db.execute(
+        f"""
+        UPDATE satspay.webhook_outbox SET status = 'pending', claimed_until = NULL
+        WHERE status = 'sending'
+        AND claimed_until <= {db.timestamp_placeholder("now")}
+        """,
+        {"now": int(time.time())},
+    )
+
+
+async def delete_webhook_deliveries(before: float) -> None:
+    await db.execute(
+        f"""
+        DELETE FROM satspay.webhook_outbox
+        WHERE status IN ('delivered', 'failed')
+        AND created_at < {db.timestamp_placeholder("before")}
+        """,
+        {"before": int(before)},
+    )
+
+
+async def add_pooled_address(wallet: str, user: str, address: str) -> None:
+    await db.execute(
+        """
+        INSERT INTO satspay.address_pool (address, wallet, "user")
+        VALUES (:address, :wallet, :user)
+        """,
+        {"address": address, "wallet": wallet, "user": user},
+    )
+
+
+async def count_pooled_addresses(wallet: str, user: str) -> int:
+    row = await db.fetchone(
+        """
+        SELECT COUNT(*) AS count FROM satspay.address_pool
+        WHERE wallet = :wallet AND "user" = :user
+        """,
+        {"wallet": wallet, "user": user},
+    )
+    return row["count"] if row else 0
+
+
+async def claim_pooled_address(wallet: str, user: str) -> Optional[str]:
+    """
+    Take the oldest pooled address of the wallet. Deleting the row is the claim,
+    so an address is never handed out twice, not even by another worker.
+    """
+    rows = await db.fetchall(
+        """
+        SELECT address FROM satspay.address_pool
+        WHERE wallet = :wallet AND "user" = :user
+        ORDER BY created_at LIMIT 5
+        """,
+        {"wallet": wallet, "user": user},
+    )
+    for row in rows:
+        result = await db.execute(
+            "DELETE FROM satspay.address_pool WHERE address = :address",
+            {"address": row["address"]},
+        )
+        if result.rowcount:
+            return row["address"]
+    return None
+
+
+async def create_charge_notification(origin: str, charge_id: str, payload: str):
+    await db.execute(
+        """
+        INSERT INTO satspay.notifications (origin, charge_id, payload)
+        VALUES (:origin, :charge_id, :payload)
+        """,
+        {"origin": origin, "charge_id": charge_id, "payload": payload},
+    )
+
+
+async def get_last_charge_notification_id() -> int:
+    notification = await db.fetchone(
+        "SELECT * FROM satspay.notifications ORDER BY id DESC LIMIT 1",
+        model=ChargeNotification,
+    )
+    return notification.id if notification else 0
+
+
+async def get_charge_notifications(
+    after_id: int, limit: int = 500
+) -> list[ChargeNotification]:
+    return await db.fetchall(
+        """
+        SELECT * FROM satspay.notifications WHERE id > :after_id
+        ORDER BY id LIMIT :limit
+        """,
+        {"after_id": after_id, "limit": limit},
+        ChargeNotification,
+    )
+
+
+async def delete_charge_notifications(before: float) -> None:
+    await db.execute(
+        f"""
+        DELETE FROM satspay.notifications
+        WHERE created_at < {db.timestamp_placeholder("before")}
+        """,
+        {"before": int(before)},
+    )
+
+
+async def get_or_create_satspay_settings() -> SatspaySettings:
+    """
+    Settings are read on every hot path but hardly ever change, so they are kept
+    in memory for `SETTINGS_CACHE_TTL` seconds or until they are updated here.
+    """
+    global _settings_cache, _settings_cached_at
+    if _settings_cache and time.monotonic() - _settings_cached_at < SETTINGS_CACHE_TTL:
+        return _settings_cache
+    async with _settings_lock:
+        if (
+            _settings_cache
+            and time.monotonic() - _settings_cached_at < SETTINGS_CACHE_TTL
+        ):
+            return _settings_cache
+        settings = await db.fetchone(
+            "SELECT * FROM satspay.settings LIMIT 1",
+            model=SatspaySettings,
+        )
+        if not settings:
+            settings = SatspaySettings()
+            await db.insert("satspay.settings", settings)
+        _settings_cache = settings
+        _settings_cached_at = time.monotonic()
         return settings
 
 
 async def update_satspay_settings(settings: SatspaySettings) -> SatspaySettings:
-    # 3rd arguments `WHERE clause` is empty for settings
-    await db.update("satspay.settings", settings, "")
+    global _settings_cache, _settings_cached_at
+    async with _settings_lock:
+        # 3rd arguments `WHERE clause` is empty for settings
+        await db.update("satspay.settings", settings, "")
+        _settings_cache = settings
+        _settings_cached_at = time.monotonic()
     return settings
 
 
 async def delete_satspay_settings() -> None:
-    await db.execute("DELETE FROM satspay.settings")
+    global _settings_cache
+    async with _settings_lock:
+        await db.execute("DELETE FROM satspay.settings")
+        _settings_cache = None
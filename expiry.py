@@ -0,0 +1,76 @@
+import asyncio
+import heapq
+import time
+from collections.abc import Awaitable
+from typing import Callable, Optional
+
+from lnbits.settings import settings
+from loguru import logger
+
+from .models import Charge
+
+
+class ExpiryScheduler:
+    """
+    Heap of pending charges ordered by their expiry time.
+
+    Cancelling a charge only forgets its deadline, the stale heap entry is
+    dropped lazily once it reaches the top of the heap.
+    """
+
+    def __init__(self):
+        self._heap: list[tuple[float, str]] = []
+        self._deadlines: dict[str, float] = {}
+        self._wakeup = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self._deadlines)
+
+    def schedule(self, charge: Charge) -> None:
+        expires_at = charge.expires_at
+        if self._deadlines.get(charge.id) == expires_at:
+            return
+        self._deadlines[charge.id] = expires_at
+        heapq.heappush(self._heap, (expires_at, charge.id))
+        if self._heap[0][1] == charge.id:
+            self._wakeup.set()
+
+    def cancel(self, charge_id: str) -> None:
+        self._deadlines.pop(charge_id, None)
+
+    def _pop_due(self, now: float) -> list[str]:
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            expires_at, charge_id = heapq.heappop(self._heap)
+            if self._deadlines.get(charge_id) == expires_at:
+                del self._deadlines[charge_id]
+                due.append(charge_id)
+        return due
+
+    def _next_deadline(self) -> Optional[float]:
+        while self._heap:
+            expires_at, charge_id = self._heap[0]
+            if self._deadlines.get(charge_id) == expires_at:
+                return expires_at
+            heapq.heappop(self._heap)
+        return None
+
+    async def run(self, on_expired: Callable[[str], Awaitable[None]]) -> None:
+        while settings.lnbits_running:
+            self._wakeup.clear()
+            next_deadline = self._next_deadline()
+            timeout = None if next_deadline is None else next_deadline - time.time()
+            if timeout is None or timeout > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            for charge_id in self._pop_due(time.time()):
+                try:
+                    await on_expired(charge_id)
+                except Exception as exc:
+                    logger.warning(f"Expiring charge {charge_id} failed: {exc!s}")
+
+
+expiry_scheduler = ExpiryScheduler()
@@ -0,0 +1,76 @@
+import asyncio
+import time
+from collections import defaultdict
+from datetime import datetime
+
+from lnbits.tasks import create_unique_task
+from lnbits.utils.exchange_rates import get_fiat_rate_satoshis
+from loguru import logger
+
+from .crud import get_or_create_satspay_settings
+from .models import FiatRate
+
+# a rate older than this is not used anymore, even if the provider is down
+FIAT_RATE_MAX_AGE = 15 * 60
+
+
+class FiatRateCache:
+    """
+    Exchange rates per currency. Rates are refreshed on read: a rate older than
+    the configured ttl is still returned right away while a fresh one is fetched
+    in the background, only a missing or very old rate makes the caller wait for
+    the provider. Currencies nobody asks for are not kept up to date.
+    """
+
+    def __init__(self):
+        self._rates: dict[str, FiatRate] = {}
+        self._refreshing: set[str] = set()
+        # one fetch per currency at a time
+        self._locks: defaultdict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+    async def get(self, currency: str) -> FiatRate:
+        satspay_settings = await get_or_create_satspay_settings()
+        rate = self._rates.get(currency)
+        age = time.time() - rate.timestamp.timestamp() if rate else FIAT_RATE_MAX_AGE
+        if rate and age < FIAT_RATE_MAX_AGE:
+            if age >= satspay_settings.fiat_rate_ttl:
+                self.refresh_soon(currency)
+            return rate
+        return await self.refresh(currency)
+
+    async def refresh(self, currency: str) -> FiatRate:
+        requested = time.time()
+        async with self._locks[currency]:
+            # callers that waited for the lock use the rate fetched meanwhile
+            rate = self._rates.get(currency)
+            if rate and rate.timestamp.timestamp() >= requested:
+                return rate
+            return await self._fetch(currency)
+
+    def refresh_soon(self, currency: str) -> None:
+        if currency in self._refreshing:
+            return
+        self._refreshing.add(currency)
+        create_unique_task(
+            f"ext_satspay_fiat_rate_{currency}", self._background_refresh(currency)
+        )
+
+    async def _background_refresh(self, currency: str) -> None:
+        try:
+            await self.refresh(currency)
+        except Exception as exc:
+            logger.warning(f"Refreshing {currency} rate failed: {exc!s}")
+        finally:
+            self._refreshing.discard(currency)
+
+    async def _fetch(self, currency: str) -> FiatRate:
+        rate = FiatRate(
+            currency=currency,
+            rate=await get_fiat_rate_satoshis(currency),
+            timestamp=datetime.now(),
+        )
+        self._rates[currency] = rate
+        return rate
+
+
+fiat_rates = FiatRateCache()
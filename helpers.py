@@ -1,89 +1,128 @@
-import httpx
+from contextvars import ContextVar
+
 from lnbits.core.crud import get_standalone_payment
 from lnbits.settings import settings
 from loguru import logger
 
-from .crud import get_or_create_satspay_settings
-from .models import Charge, OnchainBalance
-
-
-async def call_webhook(charge: Charge):
-    try:
-        assert charge.webhook
-        settings = await get_or_create_satspay_settings()
-        async with httpx.AsyncClient() as client:
-            # wordpress expect a GET request with json_encoded binary content
-            if settings.webhook_method == "GET":
-                r = await client.request(
-                    method="GET",
-                    url=charge.webhook,
-                    content=charge.json(),
-                    timeout=10,
-                )
-            else:
-                r = await client.post(
-                    url=charge.webhook,
-                    json=charge.json(),
-                    timeout=10,
-                )
-            if r.is_success:
-                logger.success(f"Webhook sent for charge {charge.id}")
-            else:
-                logger.warning(f"Failed to call webhook for charge {charge.id}")
-                logger.warning(charge.webhook)
-                logger.warning(r.text)
-            return {
-                "webhook_success": r.is_success,
-                "webhook_message": r.reason_phrase,
-                "webhook_response": r.text,
-            }
-    except Exception as e:
-        logger.warning(f"Failed to call webhook for charge {charge.id}")
-        logger.warning(e)
-        return {"webhook_success": False, "webhook_message": str(e)}
+from .cache import LRUCache
+from .crud import (
+    delete_charge_transactions,
+    get_charge_transactions,
+    get_or_create_satspay_settings,
+    set_settling_transaction,
+    upsert_charge_transactions,
+)
+from .http_clients import LNBITS, MEMPOOL, get_http_client
+from .models import Charge, OnchainBalance, OnchainTransaction, SatspaySettings
+from .throttle import SingleFlight, TokenBucket
+from .webhooks import enqueue_webhook
+
+# mempool returns confirmed address transactions in pages of 25
+MEMPOOL_CHAIN_PAGE_SIZE = 25
+
+# already confirmed transactions per mempool url and address, they do not change
+# anymore (short of a reorg, which the ttl takes care of)
+confirmed_txs_cache: LRUCache[tuple[str, str], dict[str, OnchainTransaction]] = (
+    LRUCache(maxsize=10000, ttl=60 * 60)
+)
+# the watchonly network of a key hardly ever changes
+wallet_network_cache: LRUCache[str, str] = LRUCache(maxsize=1000, ttl=10 * 60)
+BALANCE_CACHE_TTL = 5
+balance_requests: SingleFlight[OnchainBalance] = SingleFlight(ttl=BALANCE_CACHE_TTL)
+mempool_rate_limiter = TokenBucket(rate=SatspaySettings().mempool_rate_limit)
+# reconciling all charges on startup has a budget of its own, so it neither takes
+# hours nor starves the balance checks of the checkout pages
+reconcile_rate_limiter = TokenBucket(rate=SatspaySettings().reconcile_rate_limit)
+mempool_budget: ContextVar[TokenBucket] = ContextVar(
+    "mempool_budget", default=mempool_rate_limiter
+)
 
 
 async def fetch_onchain_balance(onchain_address: str) -> OnchainBalance:
+    """
+    Concurrent checks of the same address share one lookup, whose result is
+    reused for a few seconds.
+    """
+    return await balance_requests.do(
+        onchain_address, lambda: _fetch_onchain_balance(onchain_address)
+    )
+
+
+async def _mempool_get(url: str) -> list[dict]:
+    await mempool_budget.get().acquire()
+    res = await get_http_client(MEMPOOL).get(url)
+    res.raise_for_status()
+    return res.json()
+
+
+async def _fetch_onchain_balance(onchain_address: str) -> OnchainBalance:
+    """
+    Confirmed transactions are paged through newest first and only until the
+    first already known one, so repeated checks only download what is new.
+    `transactions` holds the new confirmed and all unconfirmed transactions.
+    """
     settings = await get_or_create_satspay_settings()
-    async with httpx.AsyncClient() as client:
-        res = await client.get(
-            f"{settings.mempool_url}/api/address/{onchain_address}/txs"
+    mempool_rate_limiter.configure(settings.mempool_rate_limit)
+    reconcile_rate_limiter.configure(settings.reconcile_rate_limit)
+    url = f"{settings.mempool_url}/api/address/{onchain_address}/txs"
+    cache_key = (settings.mempool_url, onchain_address)
+    known = confirmed_txs_cache.get(cache_key) or {}
+
+    new_confirmed_txs: list[dict] = []
+    last_seen_txid = None
+    while True:
+        page = await _mempool_get(
+            f"{url}/chain/{last_seen_txid}" if last_seen_txid else f"{url}/chain"
         )
-        res.raise_for_status()
-        data = res.json()
-        confirmed_txs = [tx for tx in data if tx["status"]["confirmed"]]
-        unconfirmed_txs = [tx for tx in data if not tx["status"]["confirmed"]]
-        txids = [tx["txid"] for tx in data]
-        confirmed = sum_transactions(onchain_address, confirmed_txs)
-        unconfirmed = sum_transactions(onchain_address, unconfirmed_txs)
-        return OnchainBalance(confirmed=confirmed, unconfirmed=unconfirmed, txids=txids)
+        new_txs = [tx for tx in page if tx["txid"] not in known]
+        new_confirmed_txs.extend(new_txs)
+        if len(new_txs) < len(page) or len(page) < MEMPOOL_CHAIN_PAGE_SIZE:
+            break
+        last_seen_txid = page[-1]["txid"]
+
+    unconfirmed_txs = await _mempool_get(f"{url}/mempool")
+
+    new_confirmed = parse_transactions(onchain_address, new_confirmed_txs, True)
+    unconfirmed = parse_transactions(onchain_address, unconfirmed_txs, False)
+    confirmed = {**known, **{tx.txid: tx for tx in new_confirmed}}
+    confirmed_txs_cache.set(cache_key, confirmed)
+    return OnchainBalance(
+        confirmed=sum(tx.value for tx in confirmed.values()),
+        unconfirmed=sum(tx.value for tx in unconfirmed),
+        txids=[*confirmed, *(tx.txid for tx in unconfirmed)],
+        transactions=[*new_confirmed, *unconfirmed],
+    )
 
 
 async def fetch_onchain_config_network(api_key: str) -> str:
-    async with httpx.AsyncClient() as client:
-        r = await client.get(
-            url=f"http://{settings.host}:{settings.port}/watchonly/api/v1/config",
-            headers={"X-API-KEY": api_key},
-        )
-        r.raise_for_status()
-        config = r.json()
-        return config["network"]
+    network = wallet_network_cache.get(api_key)
+    if network:
+        return network
+    client = get_http_client(LNBITS)
+    r = await client.get(
+        url=f"http://{settings.host}:{settings.port}/watchonly/api/v1/config",
+        headers={"X-API-KEY": api_key},
+    )
+    r.raise_for_status()
+    config = r.json()
+    wallet_network_cache.set(api_key, config["network"])
+    return config["network"]
 
 
 async def fetch_onchain_address(wallet_id: str, api_key: str) -> str:
-    async with httpx.AsyncClient() as client:
-        r = await client.get(
-            url=f"http://{settings.host}:{settings.port}/watchonly/api/v1/address/{wallet_id}",
-            headers={"X-API-KEY": api_key},
-        )
-        r.raise_for_status()
-        address_data = r.json()
-        if not address_data and "address" not in address_data:
-            raise ValueError("Cannot fetch new address!")
-        return address_data["address"]
+    client = get_http_client(LNBITS)
+    r = await client.get(
+        url=f"http://{settings.host}:{settings.port}/watchonly/api/v1/address/{wallet_id}",
+        headers={"X-API-KEY": api_key},
+    )
+    r.raise_for_status()
+    address_data = r.json()
+    if not address_data and "address" not in address_data:
+        raise ValueError("Cannot fetch new address!")
+    return address_data["address"]
 
 
-async def check_charge_balance(charge: Charge) -> Charge:
+async def check_charge_balance(charge: Charge, send_webhook: bool = True) -> Charge:
     if charge.paid:
         return charge
 
@@ -98,7 +137,18 @@ async def check_charge_balance(charge: Charge) -> Charge:
     if charge.onchainaddress:
         try:
             balance = await fetch_onchain_balance(charge.onchainaddress)
-            charge.add_extra({"txids": balance.txids})
+            await upsert_charge_transactions(
+                charge.id, charge.onchainaddress, balance.transactions
+            )
+            # mempool transactions that were replaced or dropped while the
+            # websocket was down are only noticed here
+            dropped = [
+                tx.txid
+                for tx in await get_charge_transactions(charge.id)
+                if tx.status != "confirmed" and tx.txid not in balance.txids
+            ]
+            if dropped:
+                await delete_charge_transactions(charge.id, dropped)
             if (
                 balance.confirmed != charge.balance
                 or balance.unconfirmed != charge.pending
@@ -114,14 +164,47 @@ async def check_charge_balance(charge: Charge) -> Charge:
             logger.warning(f"Charge check onchain address failed with: {exc!s}")
 
     charge.paid = charge.balance >= charge.amount
+    if charge.paid and charge.onchainaddress:
+        await mark_settling_transaction(charge)
 
-    if charge.webhook:
-        resp = await call_webhook(charge)
-        charge.add_extra(resp)
+    if charge.webhook and send_webhook:
+        await enqueue_webhook(charge)
 
     return charge
 
 
+async def mark_settling_transaction(charge: Charge) -> None:
+    """
+    Flag the transaction that pushed the charge over its amount.
+    """
+    transactions = await get_charge_transactions(charge.id)
+    if any(tx.settles_charge for tx in transactions):
+        return
+    # confirmed ones in block order first, then whatever is still in the mempool
+    counted = sorted(
+        (tx for tx in transactions if tx.status == "confirmed" or charge.zeroconf),
+        key=lambda tx: tx.block_height or float("inf"),
+    )
+    total = 0
+    for tx in counted:
+        total += tx.value
+        if total >= charge.amount:
+            await set_settling_transaction(charge.id, tx.txid)
+            return
+
+
+def parse_transactions(address: str, txs, confirmed: bool) -> list[OnchainTransaction]:
+    return [
+        OnchainTransaction(
+            txid=tx["txid"],
+            value=sum_outputs(address, tx["vout"]),
+            confirmed=confirmed,
+            block_height=tx.get("status", {}).get("block_height"),
+        )
+        for tx in txs
+    ]
+
+
 def sum_outputs(address: str, vouts) -> int:
     return sum(
         [vout["value"] for vout in vouts if vout.get("scriptpubkey_address") == address]
@@ -0,0 +1,70 @@
+import asyncio
+from importlib.util import find_spec
+from typing import Optional
+
+import httpx
+from loguru import logger
+
+from .crud import get_or_create_satspay_settings
+from .models import SatspaySettings
+
+# http/2 needs the optional `h2` package
+HTTP2_AVAILABLE = find_spec("h2") is not None
+
+# one pool per upstream, so a slow merchant webhook can not starve mempool calls
+MEMPOOL = "mempool"
+WEBHOOK = "webhook"
+LNBITS = "lnbits"
+
+_clients: dict[str, httpx.AsyncClient] = {}
+
+
+def _create_client(name: str, satspay_settings: SatspaySettings) -> httpx.AsyncClient:
+    # httpx limits a whole pool, not a single host. for webhooks the per host
+    # limit is enforced by the dispatcher, see `WEBHOOK_MAX_PER_HOST`
+    limits = httpx.Limits(
+        max_connections=satspay_settings.http_max_connections,
+        max_keepalive_connections=satspay_settings.http_max_connections,
+        keepalive_expiry=60,
+    )
+    return httpx.AsyncClient(
+        limits=limits,
+        timeout=httpx.Timeout(satspay_settings.http_timeout),
+        # the loopback watchonly api is plain http/1.1
+        http2=HTTP2_AVAILABLE and name != LNBITS,
+    )
+
+
+def get_http_client(name: str) -> httpx.AsyncClient:
+    client = _clients.get(name)
+    if not client or client.is_closed:
+        client = _create_client(name, SatspaySettings())
+        _clients[name] = client
+    return client
+
+
+async def start_http_clients(satspay_settings: Optional[SatspaySettings] = None):
+    """
+    (Re)create the client pools with the configured limits and timeouts.
+    """
+    satspay_settings = satspay_settings or await get_or_create_satspay_settings()
+    old_clients = list(_clients.values())
+    for name in (MEMPOOL, WEBHOOK, LNBITS):
+        _clients[name] = _create_client(name, satspay_settings)
+    logger.debug(f"Started http clients (http2: {HTTP2_AVAILABLE}).")
+    if not old_clients:
+        return
+    try:
+        # let requests that are still in flight on the old pools finish
+        await asyncio.sleep(satspay_settings.http_timeout)
+    finally:
+        # also when the next settings change cancels this task
+        for client in old_clients:
+            await client.aclose()
+
+
+async def close_http_clients():
+    clients = list(_clients.values())
+    _clients.clear()
+    for client in clients:
+        await client.aclose()
@@ -0,0 +1,88 @@
+import asyncio
+import time
+from collections import deque
+from collections.abc import Awaitable
+from typing import Any, Callable
+
+from lnbits.settings import settings
+from loguru import logger
+
+THROUGHPUT_WINDOW = 60
+
+
+class KeyedWorkerPool:
+    """
+    Processes jobs with a fixed number of workers. Jobs with different keys run
+    concurrently, jobs with the same key run one after another in submit order.
+    """
+
+    def __init__(self, handler: Callable[[str, Any], Awaitable[None]], workers: int):
+        self.handler = handler
+        self.workers = workers
+        self.processed = 0
+        self.failed = 0
+        self._pending: dict[str, deque] = {}
+        self._ready: asyncio.Queue[str] = asyncio.Queue()
+        self._completed: deque[float] = deque()
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(jobs) for jobs in self._pending.values())
+
+    @property
+    def throughput(self) -> float:
+        """
+        Jobs per second over the last minute.
+        """
+        self._trim_completed()
+        return len(self._completed) / THROUGHPUT_WINDOW
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "queue_depth": self.queue_depth,
+            "active_keys": len(self._pending),
+            "processed": self.processed,
+            "failed": self.failed,
+            "throughput": round(self.throughput, 2),
+        }
+
+    def submit(self, key: str, job: Any) -> None:
+        jobs = self._pending.get(key)
+        if jobs is None:
+            jobs = self._pending[key] = deque()
+            self._ready.put_nowait(key)
+        jobs.append(job)
+
+    async def run(self) -> None:
+        # jobs left over by workers that were cancelled are picked up again
+        self._ready = asyncio.Queue()
+        for key in self._pending:
+            self._ready.put_nowait(key)
+        tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _worker(self) -> None:
+        while settings.lnbits_running:
+            key = await self._ready.get()
+            jobs = self._pending[key]
+            while jobs:
+                job = jobs.popleft()
+                try:
+                    await self.handler(key, job)
+                    self.processed += 1
+                except Exception as exc:
+                    self.failed += 1
+                    logger.warning(f"Processing job for `{key}` failed: {exc!s}")
+                self._completed.append(time.monotonic())
+                self._trim_completed()
+            del self._pending[key]
+
+    def _trim_completed(self) -> None:
+        cutoff = time.monotonic() - THROUGHPUT_WINDOW
+        while self._completed and self._completed[0] < cutoff:
+            self._completed.popleft()
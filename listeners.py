@@ -0,0 +1,92 @@
+import asyncio
+from typing import Optional
+
+from fastapi import WebSocket, WebSocketDisconnect
+from lnbits.settings import settings
+from loguru import logger
+
+LISTENER_QUEUE_SIZE = 8
+SEND_TIMEOUT = 10
+HEARTBEAT_INTERVAL = 30
+
+
+class PublicListener:
+    """
+    A browser waiting on the checkout page of a charge.
+
+    Messages are pushed into a small bounded queue and sent by the connection's
+    own task, so a slow or stalled browser only ever delays itself.
+    """
+
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        self.queue: asyncio.Queue[dict] = asyncio.Queue(maxsize=LISTENER_QUEUE_SIZE)
+
+    def push(self, message: dict) -> None:
+        if self.queue.full():
+            # only the latest charge status matters, drop the oldest one
+            self.queue.get_nowait()
+        self.queue.put_nowait(message)
+
+    async def _send(self, message: dict) -> None:
+        await asyncio.wait_for(self.websocket.send_json(message), timeout=SEND_TIMEOUT)
+
+    async def _sender(self) -> None:
+        while settings.lnbits_running:
+            try:
+                message: Optional[dict] = await asyncio.wait_for(
+                    self.queue.get(), timeout=HEARTBEAT_INTERVAL
+                )
+            except asyncio.TimeoutError:
+                message = None
+            # a heartbeat that can not be delivered in time evicts a dead socket
+            await self._send(message or {"heartbeat": True})
+
+    async def _receiver(self) -> None:
+        while settings.lnbits_running:
+            await self.websocket.receive_text()
+
+    async def run(self) -> None:
+        tasks = [
+            asyncio.create_task(self._sender()),
+            asyncio.create_task(self._receiver()),
+        ]
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+        for task in done:
+            exc = task.exception()
+            if exc and not isinstance(exc, WebSocketDisconnect):
+                logger.debug(f"Public websocket closed: {exc!r}")
+
+
+class PublicListenerRegistry:
+    """
+    Listeners grouped by charge id.
+    """
+
+    def __init__(self):
+        self._listeners: dict[str, set[PublicListener]] = {}
+
+    def __len__(self) -> int:
+        return sum(len(listeners) for listeners in self._listeners.values())
+
+    def add(self, charge_id: str, listener: PublicListener) -> None:
+        self._listeners.setdefault(charge_id, set()).add(listener)
+
+    def remove(self, charge_id: str, listener: PublicListener) -> None:
+        listeners = self._listeners.get(charge_id)
+        if not listeners:
+            return
+        listeners.discard(listener)
+        if not listeners:
+            del self._listeners[charge_id]
+
+    def notify(self, charge_id: str, message: dict) -> int:
+        listeners = self._listeners.get(charge_id, ())
+        for listener in listeners:
+            listener.push(message)
+        return len(listeners)
+
+
+public_listeners = PublicListenerRegistry()
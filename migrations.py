@@ -1,4 +1,6 @@
-from lnbits.db import Database
+from urllib.parse import urlparse
+
+from lnbits.db import SQLITE, Database
 from sqlalchemy.exc import OperationalError
 
 
@@ -210,3 +212,329 @@ async def m014_fasttrack_to_charge(db: Database):
         )
     except OperationalError:
         pass
+
+
+async def m015_add_setting_websocket_shards(db: Database):
+    """
+    Add 'websocket_shards' and 'addresses_per_shard' columns for configuring
+    the mempool websocket connection pool
+    """
+    try:
+        await db.execute(
+            "ALTER TABLE satspay.settings ADD COLUMN websocket_shards INTEGER"
+        )
+        await db.execute(
+            "ALTER TABLE satspay.settings ADD COLUMN addresses_per_shard INTEGER"
+        )
+        await db.execute(
+            """
+            UPDATE satspay.settings
+            SET websocket_shards = 1, addresses_per_shard = 0
+            """
+        )
+    except OperationalError:
+        pass
+
+
+async def m016_add_expired_column(db: Database):
+    """
+    Add 'expired' column for marking charges that ran out of time unpaid
+    """
+    try:
+        await db.execute(
+            "ALTER TABLE satspay.charges ADD COLUMN expired BOOLEAN DEFAULT FALSE"
+        )
+    except OperationalError:
+        pass
+
+
+async def m017_add_setting_reconcile_concurrency(db: Database):
+    """
+    Add 'reconcile_concurrency' column for limiting parallel balance checks
+    on startup
+    """
+    try:
+        await db.execute(
+            "ALTER TABLE satspay.settings ADD COLUMN reconcile_concurrency INTEGER"
+        )
+        await db.execute("UPDATE satspay.settings SET reconcile_concurrency = 10")
+    except OperationalError:
+        pass
+
+
+async def m018_add_charge_indexes(db: Database):
+    """
+    Add indexes for the address lookup, the pending charges and the user listing
+    """
+    indexes = {
+        "charges_onchainaddress_idx": "(onchainaddress)",
+        "charges_user_timestamp_idx": '("user", timestamp)',
+        "charges_pending_idx": "(timestamp) WHERE paid = false AND expired = false",
+    }
+    for name, columns in indexes.items():
+        # sqlite expects the schema on the index, postgres on the table
+        if db.type == SQLITE:
+            await db.execute(
+                f"CREATE INDEX IF NOT EXISTS satspay.{name} ON charges {columns}"
+            )
+        else:
+            await db.execute(
+                f"CREATE INDEX IF NOT EXISTS {name} ON satspay.charges {columns}"
+            )
+
+
+async def m019_add_setting_http_client(db: Database):
+    """
+    Add 'http_timeout' and 'http_max_connections' columns for configuring
+    the outgoing http connection pools
+    """
+    try:
+        await db.execute("ALTER TABLE satspay.settings ADD COLUMN http_timeout INTEGER")
+        await db.execute(
+            "ALTER TABLE satspay.settings ADD COLUMN http_max_connections INTEGER"
+        )
+        await db.execute(
+            "UPDATE satspay.settings SET http_timeout = 10, http_max_connections = 20"
+        )
+    except OperationalError:
+        pass
+
+
+async def m020_add_webhook_outbox(db: Database):
+    """
+    Webhook outbox table, deliveries are sent and retried by background workers
+    """
+    await db.execute(
+        f"""
+        CREATE TABLE satspay.webhook_outbox (
+            id TEXT NOT NULL PRIMARY KEY,
+            charge_id TEXT NOT NULL,
+            url TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_message TEXT,
+            last_response TEXT,
+            next_attempt_at TIMESTAMP NOT NULL DEFAULT {db.timestamp_now},
+            created_at TIMESTAMP NOT NULL DEFAULT {db.timestamp_now}
+        );
+        """
+    )
+    indexes = {
+        "webhook_outbox_charge_idx": "(charge_id, created_at)",
+        "webhook_outbox_due_idx": "(next_attempt_at) WHERE status = 'pending'",
+    }
+    for name, columns in indexes.items():
+        if db.type == SQLITE:
+            await db.execute(
+                f"CREATE INDEX IF NOT EXISTS satspay.{name} ON webhook_outbox {columns}"
+            )
+        else:
+            await db.execute(
+                f"CREATE INDEX IF NOT EXISTS {name} ON satspay.webhook_outbox {columns}"
+            )
+
+
+async def m021_add_notifications(db: Database):
+    """
+    Notifications table for relaying charge updates between workers and
+    'notification_backend' setting for choosing how they are relayed
+    """
+    await db.execute(
+        f"""
+        CREATE TABLE satspay.notifications (
+            id {db.serial_primary_key},
+            origin TEXT NOT NULL,
+            charge_id TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT {db.timestamp_now}
+        );
+        """
+    )
+    try:
+        await db.execute(
+            "ALTER TABLE satspay.settings ADD COLUMN notification_backend TEXT"
+        )
+        await db.execute("UPDATE satspay.settings SET notification_backend = 'local'")
+    except OperationalError:
+        pass
+
+
+async def m022_add_charge_version(db: Database):
+    """
+    Add 'version' column for optimistic concurrency of charge updates
+    """
+    try:
+        await db.execute(
+            "ALTER TABLE satspay.charges ADD COLUMN version INTEGER NOT NULL DEFAULT 0"
+        )
+    except OperationalError:
+        pass
+
+
+async def m023_add_charge_transactions(db: Database):
+    """
+    Onchain transactions paying into a charge, one row per (charge_id, txid)
+    """
+    await db.execute(
+        f"""
+        CREATE TABLE satspay.charge_transactions (
+            charge_id TEXT NOT NULL,
+            txid TEXT NOT NULL,
+            address TEXT NOT NULL,
+            value {db.big_int} NOT NULL DEFAULT 0,
+            status TEXT NOT NULL,
+            block_height INTEGER,
+            settles_charge BOOLEAN NOT NULL DEFAULT FALSE,
+            created_at TIMESTAMP NOT NULL DEFAULT {db.timestamp_now},
+            PRIMARY KEY (charge_id, txid)
+        );
+        """
+    )
+    if db.type == SQLITE:
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS satspay.charge_transactions_txid_idx "
+            "ON charge_transactions (txid)"
+        )
+    else:
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS charge_transactions_txid_idx "
+            "ON satspay.charge_transactions (txid)"
+        )
+
+
+async def m024_add_setting_mempool_rate_limit(db: Database):
+    """
+    Add 'mempool_rate_limit' column, requests per second to the mempool rest api
+    """
+    try:
+        await db.execute(
+            "ALTER TABLE satspay.settings ADD COLUMN mempool_rate_limit INTEGER"
+        )
+        await db.execute("UPDATE satspay.settings SET mempool_rate_limit = 5")
+    except OperationalError:
+        pass
+
+
+async def m025_add_address_pool(db: Database):
+    """
+    Pre-allocated onchain addresses per (watchonly wallet, user), handed out to
+    new charges without asking the watchonly extension first
+    """
+    await db.execute(
+        f"""
+        CREATE TABLE satspay.address_pool (
+            address TEXT NOT NULL PRIMARY KEY,
+            wallet TEXT NOT NULL,
+            "user" TEXT NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT {db.timestamp_now}
+        );
+        """
+    )
+    if db.type == SQLITE:
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS satspay.address_pool_wallet_idx "
+            'ON address_pool (wallet, "user", created_at)'
+        )
+    else:
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS address_pool_wallet_idx "
+            'ON satspay.address_pool (wallet, "user", created_at)'
+        )
+
+
+async def m026_add_fiat_rate(db: Database):
+    """
+    Add 'fiat_rate' and 'fiat_rate_timestamp' columns for storing the exchange
+    rate a fiat charge was created with and 'fiat_rate_ttl' setting
+    """
+    try:
+        await db.execute("ALTER TABLE satspay.charges ADD COLUMN fiat_rate FLOAT")
+        await db.execute(
+            "ALTER TABLE satspay.charges ADD COLUMN fiat_rate_timestamp TIMESTAMP"
+        )
+    except OperationalError:
+        pass
+    try:
+        await db.execute(
+            "ALTER TABLE satspay.settings ADD COLUMN fiat_rate_ttl INTEGER"
+        )
+        await db.execute("UPDATE satspay.settings SET fiat_rate_ttl = 60")
+    except OperationalError:
+        pass
+
+
+async def m027_add_webhook_outbox_claims(db: Database):
+    """
+    Add 'claimed_until' column, a delivery that is being sent is claimed by one
+    worker until then
+    """
+    try:
+        await db.execute(
+            "ALTER TABLE satspay.webhook_outbox ADD COLUMN claimed_until TIMESTAMP"
+        )
+    except OperationalError:
+        pass
+    if db.type == SQLITE:
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS satspay.webhook_outbox_claimed_idx "
+            "ON webhook_outbox (claimed_until) WHERE status = 'sending'"
+        )
+    else:
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS webhook_outbox_claimed_idx "
+            "ON satspay.webhook_outbox (claimed_until) WHERE status = 'sending'"
+        )
+
+
+async def m028_add_webhook_outbox_host(db: Database):
+    """
+    Add 'host' column, the host of the webhook url, for limiting concurrent
+    deliveries per merchant
+    """
+    try:
+        await db.execute(
+            "ALTER TABLE satspay.webhook_outbox "
+            "ADD COLUMN host TEXT NOT NULL DEFAULT ''"
+        )
+    except OperationalError:
+        pass
+    rows = await db.fetchall("SELECT id, url FROM satspay.webhook_outbox")
+    for row in rows:
+        await db.execute(
+            "UPDATE satspay.webhook_outbox SET host = :host WHERE id = :id",
+            {"id": row["id"], "host": urlparse(row["url"]).hostname or ""},
+        )
+
+
+async def m029_add_charge_expiry_index(db: Database):
+    """
+    Replace the pending charges index with one that also covers 'time', the
+    pending charges are selected by their expiry
+    """
+    await db.execute("DROP INDEX IF EXISTS satspay.charges_pending_idx")
+    if db.type == SQLITE:
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS satspay.charges_pending_expiry_idx "
+            "ON charges (timestamp, time) WHERE paid = false AND expired = false"
+        )
+    else:
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS charges_pending_expiry_idx "
+            "ON satspay.charges (timestamp, time) "
+            "WHERE paid = false AND expired = false"
+        )
+
+
+async def m030_add_setting_reconcile_rate_limit(db: Database):
+    """
+    Add 'reconcile_rate_limit' column, requests per second to the mempool rest api
+    for reconciling charges on startup, on top of 'mempool_rate_limit'
+    """
+    try:
+        await db.execute(
+            "ALTER TABLE satspay.settings ADD COLUMN reconcile_rate_limit INTEGER"
+        )
+        await db.execute("UPDATE satspay.settings SET reconcile_rate_limit = 20")
+    except OperationalError:
+        pass
@@ -2,16 +2,36 @@ from __future__ import annotations
 
 import json
 from datetime import datetime
-from typing import Optional
+from typing import Literal, Optional
 
 from fastapi.param_functions import Query
-from pydantic import BaseModel
+from pydantic import BaseModel, PrivateAttr
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, it only makes serializing faster
+    orjson = None
+
+
+def dumps(data: dict) -> str:
+    if orjson:
+        return orjson.dumps(data).decode()
+    return json.dumps(data)
 
 
 class SatspaySettings(BaseModel):
     webhook_method: str = "GET"
     mempool_url: str = "https://mempool.space"
     network: str = "Mainnet"
+    websocket_shards: int = 1
+    addresses_per_shard: int = 0
+    reconcile_concurrency: int = 10
+    http_timeout: int = 10
+    http_max_connections: int = 20
+    notification_backend: Literal["local", "database"] = "local"
+    mempool_rate_limit: int = 5
+    reconcile_rate_limit: int = 20
+    fiat_rate_ttl: int = 60
 
 
 class CreateCharge(BaseModel):
@@ -32,7 +52,21 @@ class CreateCharge(BaseModel):
     extra: Optional[str] = Query(None)
 
 
-class Charge(BaseModel):
+class FiatRate(BaseModel):
+    currency: str
+    rate: float
+    timestamp: datetime
+
+
+class CreateCharges(BaseModel):
+    charges: list[CreateCharge] = Query(..., min_items=1, max_items=1000)
+
+
+class ChargeSummary(BaseModel):
+    """
+    Charge without the heavy `custom_css` and `extra` columns, used for listings.
+    """
+
     id: str
     user: str
     amount: int
@@ -43,6 +77,7 @@ class Charge(BaseModel):
     zeroconf: bool = False
     fasttrack: bool = False
     paid: bool = False
+    expired: bool = False
     completelinktext: Optional[str] = "Back to Merchant"
     name: Optional[str] = None
     description: Optional[str] = None
@@ -53,14 +88,15 @@ class Charge(BaseModel):
     payment_hash: Optional[str] = None
     webhook: Optional[str] = None
     completelink: Optional[str] = None
-    custom_css: Optional[str] = None
     currency: Optional[str] = None
     currency_amount: Optional[float] = None
-    extra: Optional[str] = None
+    # sats per unit of `currency` used for `amount`, and when it was fetched
+    fiat_rate: Optional[float] = None
+    fiat_rate_timestamp: Optional[datetime] = None
 
-    def add_extra(self, extra: dict):
-        old_extra = json.loads(self.extra) if self.extra else {}
-        self.extra = json.dumps({**old_extra, **extra})
+    @property
+    def expires_at(self) -> float:
+        return self.timestamp.timestamp() + self.time * 60
 
     @property
     def paid_fasttrack(self):
@@ -69,32 +105,190 @@ class Charge(BaseModel):
         """
         return (self.pending or 0) >= self.amount and self.fasttrack or self.paid
 
+
+class PublicCharge(BaseModel):
+    """
+    The part of a charge that is shown to the payer.
+    """
+
+    id: str
+    name: Optional[str]
+    description: Optional[str]
+    onchainaddress: Optional[str]
+    payment_request: Optional[str]
+    payment_hash: Optional[str]
+    time: int
+    amount: int
+    zeroconf: bool
+    fasttrack: bool
+    balance: int
+    pending: int
+    timestamp: str
+    custom_css: Optional[str]
+    paid: bool
+    completelinktext: Optional[str]
+    completelink: Optional[str]
+
+    @classmethod
+    def from_charge(cls, charge: Charge) -> PublicCharge:
+        paid = charge.paid_fasttrack
+        # values come from a validated charge, skip validating them again
+        return cls.construct(
+            id=charge.id,
+            name=charge.name,
+            description=charge.description,
+            onchainaddress=charge.onchainaddress,
+            payment_request=charge.payment_request,
+            payment_hash=charge.payment_hash,
+            time=charge.time,
+            amount=charge.amount,
+            zeroconf=charge.zeroconf,
+            fasttrack=charge.fasttrack,
+            balance=charge.balance,
+            pending=charge.pending,
+            timestamp=charge.timestamp.isoformat(),
+            custom_css=charge.custom_css,
+            paid=paid,
+            completelinktext=charge.completelinktext,
+            completelink=charge.completelink if paid else None,
+        )
+
+    def dict(self, **_) -> dict:
+        data = dict(self.__dict__)
+        # the completelink is only revealed once the charge is paid
+        if not self.paid:
+            del data["completelink"]
+        return data
+
+    def json(self, **_) -> str:
+        return dumps(self.dict())
+
+
+class Charge(ChargeSummary):
+    custom_css: Optional[str] = None
+    extra: Optional[str] = None
+    version: int = 0
+
+    # payment state and extra keys as loaded, to re-apply only our own changes
+    # on top of a newer row after a write conflict
+    _loaded_state: tuple = PrivateAttr(default=())
+    _extra_updates: dict = PrivateAttr(default_factory=dict)
+    # `extra` parsed on first use and serialized again only when it is persisted
+    _extra_data: Optional[dict] = PrivateAttr(default=None)
+    _extra_dirty: bool = PrivateAttr(default=False)
+    _public_view: Optional[tuple[tuple, PublicCharge]] = PrivateAttr(default=None)
+
+    def __init__(self, **data):
+        super().__init__(**data)
+        self.mark_persisted()
+
+    def dict(self, **kwargs):
+        self.serialize_extra()
+        return super().dict(**kwargs)
+
+    def json(self, **kwargs):
+        self.serialize_extra()
+        return super().json(**kwargs)
+
+    @property
+    def public_view(self) -> PublicCharge:
+        """
+        Projection for checkout pages and websockets, built once per state.
+        """
+        key = (self.version, self.state)
+        if self._public_view is None or self._public_view[0] != key:
+            self._public_view = (key, PublicCharge.from_charge(self))
+        return self._public_view[1]
+
+    @property
+    def public(self) -> dict:
+        return self.public_view.dict()
+
+    @property
+    def public_status(self) -> dict:
+        """
+        Payment status pushed to the checkout page when it changes.
+        """
+        paid = self.paid_fasttrack
+        return {
+            "paid": paid,
+            "balance": self.balance,
+            "pending": self.pending,
+            "completelink": self.completelink if paid else None,
+        }
+
     @property
-    def public(self):
-        public_keys = [
-            "id",
-            "name",
-            "description",
-            "onchainaddress",
-            "payment_request",
-            "payment_hash",
-            "time",
-            "amount",
-            "zeroconf",
-            "fasttrack",
-            "balance",
-            "pending",
-            "timestamp",
-            "custom_css",
-            "paid",
-            "completelinktext",
-        ]
-        c = {k: v for k, v in self.dict().items() if k in public_keys}
-        c["paid"] = self.paid_fasttrack
-        c["timestamp"] = self.timestamp.isoformat()
-        if self.paid_fasttrack:
-            c["completelink"] = self.completelink
-        return c
+    def state(self) -> tuple:
+        return self.balance, self.pending, self.paid, self.expired
+
+    @property
+    def extra_data(self) -> dict:
+        if self._extra_data is None:
+            self._extra_data = json.loads(self.extra) if self.extra else {}
+        return self._extra_data
+
+    def serialize_extra(self) -> Optional[str]:
+        if self._extra_dirty:
+            self.extra = json.dumps(self._extra_data)
+            self._extra_dirty = False
+        return self.extra
+
+    def mark_persisted(self) -> None:
+        self._loaded_state = self.state
+        self._extra_updates = {}
+
+    def add_extra(self, extra: dict):
+        self.extra_data.update(extra)
+        self._extra_dirty = True
+        self._extra_updates.update(extra)
+
+    def rebase(self, latest: Charge) -> None:
+        """
+        Re-apply the changes made to this charge on top of a newer version of the
+        same row. A charge that is already paid stays paid.
+        """
+        changed = self.state != self._loaded_state
+        updates = self._extra_updates
+        if not changed or (latest.paid and not self.paid):
+            self.balance = latest.balance
+            self.pending = latest.pending
+            self.paid = latest.paid
+            self.expired = latest.expired
+        self.version = latest.version
+        self.extra = latest.extra
+        self._extra_data = None
+        self._extra_dirty = False
+        self._loaded_state = latest.state
+        self._extra_updates = {}
+        self.add_extra(updates)
+
+
+class ChargesPage(BaseModel):
+    data: list[ChargeSummary]
+    next_cursor: Optional[str] = None
+
+
+class CheckChargesBalance(BaseModel):
+    charge_ids: Optional[list[str]] = Query(None, max_items=1000)
+    created_after: Optional[datetime] = None
+
+
+class ChargeBalanceCheck(BaseModel):
+    charge_id: str
+    balance: int = 0
+    pending: int = 0
+    paid: bool = False
+    changed: bool = False
+    error: Optional[str] = None
+
+
+class CreateChargeResult(BaseModel):
+    """
+    One charge of a batch, either the created charge or why it failed.
+    """
+
+    charge: Optional[Charge] = None
+    error: Optional[str] = None
 
 
 class CreateSatsPayTheme(BaseModel):
@@ -109,7 +303,48 @@ class SatsPayTheme(BaseModel):
     user: str
 
 
+class OnchainTransaction(BaseModel):
+    txid: str
+    value: int
+    confirmed: bool
+    block_height: Optional[int] = None
+
+
 class OnchainBalance(BaseModel):
     confirmed: int
     unconfirmed: int
     txids: list[str]
+    transactions: list[OnchainTransaction] = []
+
+
+class ChargeTransaction(BaseModel):
+    charge_id: str
+    txid: str
+    address: str
+    value: int
+    status: str
+    block_height: Optional[int] = None
+    settles_charge: bool = False
+
+
+class WebhookDelivery(BaseModel):
+    id: str
+    charge_id: str
+    url: str
+    # lowercased host of the url, deliveries are limited per host
+    host: str = ""
+    payload: str
+    created_at: datetime
+    next_attempt_at: datetime
+    status: str = "pending"
+    attempts: int = 0
+    last_message: Optional[str] = None
+    last_response: Optional[str] = None
+    claimed_until: Optional[datetime] = None
+
+
+class ChargeNotification(BaseModel):
+    id: int
+    origin: str
+    charge_id: str
+    payload: str
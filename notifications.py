@@ -0,0 +1,121 @@
+import asyncio
+import json
+import time
+from typing import Optional
+
+from lnbits.helpers import urlsafe_short_hash
+from lnbits.settings import settings
+from lnbits.tasks import create_permanent_unique_task
+from loguru import logger
+
+from .crud import (
+    charge_cache,
+    create_charge_notification,
+    delete_charge_notifications,
+    get_charge_notifications,
+    get_last_charge_notification_id,
+    get_or_create_satspay_settings,
+)
+from .listeners import public_listeners
+
+NOTIFICATION_POLL_INTERVAL = 1
+NOTIFICATION_RETENTION = 10 * 60
+# ids are handed out before their transaction commits, a lower id can show up
+# after a higher one was already relayed. gaps are re-read for this many seconds
+NOTIFICATION_GAP_TIMEOUT = 30
+
+
+class NotificationBus:
+    """
+    Delivers charge status updates to the public websockets of this process.
+    """
+
+    async def publish(self, charge_id: str, message: dict) -> None:
+        public_listeners.notify(charge_id, message)
+
+    async def run(self) -> None:
+        while settings.lnbits_running:
+            await asyncio.sleep(3600)
+
+
+class DatabaseNotificationBus(NotificationBus):
+    """
+    Also relays updates through the `satspay.notifications` table, so websockets
+    held by other workers of the same LNbits instance are notified as well.
+    Works the same on sqlite and postgres, at the cost of a cheap indexed poll.
+    """
+
+    def __init__(self):
+        self.origin = urlsafe_short_hash()
+        self.last_id = 0
+        # ids below `last_id` that were not seen yet, with the time they were missed
+        self.missing_ids: dict[int, float] = {}
+
+    async def publish(self, charge_id: str, message: dict) -> None:
+        await super().publish(charge_id, message)
+        await create_charge_notification(self.origin, charge_id, json.dumps(message))
+
+    async def run(self) -> None:
+        self.last_id = await get_last_charge_notification_id()
+        last_cleanup = time.time()
+        while settings.lnbits_running:
+            await asyncio.sleep(NOTIFICATION_POLL_INTERVAL)
+            await self.poll()
+            if time.time() - last_cleanup > NOTIFICATION_RETENTION:
+                await delete_charge_notifications(time.time() - NOTIFICATION_RETENTION)
+                last_cleanup = time.time()
+
+    async def poll(self) -> None:
+        now = time.time()
+        # rolled back inserts leave gaps for good, stop waiting for them
+        for notification_id, missed_at in list(self.missing_ids.items()):
+            if now - missed_at > NOTIFICATION_GAP_TIMEOUT:
+                del self.missing_ids[notification_id]
+        after_id = min(self.missing_ids, default=self.last_id + 1) - 1
+        for notification in await get_charge_notifications(after_id):
+            if notification.id > self.last_id:
+                for missing_id in range(self.last_id + 1, notification.id):
+                    self.missing_ids[missing_id] = now
+                self.last_id = notification.id
+            elif self.missing_ids.pop(notification.id, None) is None:
+                continue  # already relayed
+            if notification.origin == self.origin:
+                continue
+            # the charge was updated by another worker
+            charge_cache.pop(notification.charge_id)
+            public_listeners.notify(
+                notification.charge_id, json.loads(notification.payload)
+            )
+
+
+notification_bus: NotificationBus = NotificationBus()
+notification_task: Optional[asyncio.Task] = None
+
+
+def restart_notification_task():
+    global notification_task
+    if notification_task:
+        notification_task.cancel()
+    notification_task = create_permanent_unique_task(
+        "ext_satspay_notifications", notification_handler
+    )
+
+
+def stop_notification_task():
+    if notification_task:
+        notification_task.cancel()
+
+
+async def notification_handler():
+    global notification_bus
+    satspay_settings = await get_or_create_satspay_settings()
+    if satspay_settings.notification_backend == "database":
+        notification_bus = DatabaseNotificationBus()
+    else:
+        notification_bus = NotificationBus()
+    logger.info(f"Using {type(notification_bus).__name__} for charge updates.")
+    await notification_bus.run()
+
+
+async def publish_charge_update(charge_id: str, message: dict) -> None:
+    await notification_bus.publish(charge_id, message)
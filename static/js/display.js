@@ -43,6 +43,7 @@ window.app = Vue.createApp({
       this.ws = new WebSocket(url)
       this.ws.addEventListener('message', async ({data}) => {
         const res = JSON.parse(data.toString())
+        if (res.heartbeat) return
         this.charge.balance = res.balance
         this.charge.pending = res.pending
         this.charge.paid = res.paid
@@ -28,6 +28,60 @@ window.app = Vue.createApp({
           description:
             'Webhook Method with which the webhook is sent (GET is required for Woocommerce plugin). default: `GET`, or `POST`',
           name: 'webhook_method'
+        },
+        {
+          type: 'number',
+          description:
+            'Number of mempool websocket connections the tracked addresses are spread over. default: `1`',
+          name: 'websocket_shards'
+        },
+        {
+          type: 'number',
+          description:
+            'Preferred maximum of addresses per mempool websocket connection, exceeded rather than leaving an address untracked. `0` for no limit. default: `0`',
+          name: 'addresses_per_shard'
+        },
+        {
+          type: 'number',
+          description:
+            'Number of charges checked in parallel against mempool on startup. default: `10`',
+          name: 'reconcile_concurrency'
+        },
+        {
+          type: 'number',
+          description:
+            'Timeout in seconds for mempool, webhook and watchonly requests. default: `10`',
+          name: 'http_timeout'
+        },
+        {
+          type: 'number',
+          description:
+            'Maximum number of open connections per pool (mempool, webhooks, watchonly), shared by all hosts of that pool. default: `20`',
+          name: 'http_max_connections'
+        },
+        {
+          type: 'str',
+          description:
+            'How charge updates reach the checkout pages: `local` (single worker) or `database` (relay between several LNbits workers). default: `local`',
+          name: 'notification_backend'
+        },
+        {
+          type: 'number',
+          description:
+            'Maximum number of requests per second to the mempool api, `0` disables the limit. default: `5`',
+          name: 'mempool_rate_limit'
+        },
+        {
+          type: 'number',
+          description:
+            'Maximum number of requests per second to the mempool api while reconciling charges on startup, on top of the regular limit, `0` disables the limit. default: `20`',
+          name: 'reconcile_rate_limit'
+        },
+        {
+          type: 'number',
+          description:
+            'Seconds a fiat exchange rate is used before it is refreshed in the background. default: `60`',
+          name: 'fiat_rate_ttl'
         }
       ],
       filter: '',
@@ -36,6 +90,7 @@ window.app = Vue.createApp({
       balance: null,
       walletLinks: [],
       chargeLinks: [],
+      chargesCursor: null,
       themeLinks: [],
       themeOptions: [],
       onchainwallet: '',
@@ -204,19 +259,45 @@ window.app = Vue.createApp({
       return wallet.label
     },
 
-    getCharges: async function () {
+    getCharges: async function (cursor = null) {
       try {
+        const params = new URLSearchParams({limit: 200})
+        if (cursor) params.append('cursor', cursor)
         const {data} = await LNbits.api.request(
           'GET',
-          '/satspay/api/v1/charges',
+          `/satspay/api/v1/charges/paginated?${params}`,
           this.g.user.wallets[0].adminkey
         )
-        this.chargeLinks = data.map(c =>
+        const charges = data.data.map(c =>
           mapCharge(
             c,
             this.chargeLinks.find(old => old.id === c.id)
           )
         )
+        this.chargeLinks = cursor ? [...this.chargeLinks, ...charges] : charges
+        this.chargesCursor = data.next_cursor
+      } catch (error) {
+        LNbits.utils.notifyApiError(error)
+      }
+    },
+    loadMoreCharges: async function () {
+      await this.getCharges(this.chargesCursor)
+    },
+    toggleCharge: async function (row) {
+      row.expanded = !row.expanded
+      if (!row.expanded || row.detailsLoaded) return
+      // the listing skips heavy fields like `extra`, load them on demand
+      try {
+        const {data} = await LNbits.api.request(
+          'GET',
+          `/satspay/api/v1/charge/${row.id}`,
+          this.g.user.wallets[0].inkey
+        )
+        const index = this.chargeLinks.findIndex(c => c.id === row.id)
+        this.chargeLinks[index] = {
+          ...mapCharge(data, row),
+          detailsLoaded: true
+        }
       } catch (error) {
         LNbits.utils.notifyApiError(error)
       }
@@ -0,0 +1,74 @@
+import asyncio
+import gzip
+import hashlib
+from typing import Optional
+
+from .cache import LRUCache
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always available
+    brotli = None
+
+
+class ThemeStylesheet:
+    """
+    Theme css ready to be served: encoded once, hashed for the ETag and
+    compressed up front, so a request only has to pick the right variant.
+    """
+
+    def __init__(self, css: str):
+        self.body = css.encode()
+        self.revision = css_revision(css)
+        self.gzip = gzip.compress(self.body, compresslevel=9)
+        self.brotli: Optional[bytes] = brotli.compress(self.body) if brotli else None
+
+    def etag_for(self, encoding: Optional[str]) -> str:
+        # every encoding is a different representation and needs its own ETag
+        return f'"{self.revision}-{encoding}"' if encoding else f'"{self.revision}"'
+
+    def encode_for(self, accept_encoding: str) -> tuple[bytes, Optional[str]]:
+        """
+        Body and content encoding for an `Accept-Encoding` header, encodings
+        with `q=0` are refused.
+        """
+        accepted = set()
+        for item in accept_encoding.split(","):
+            encoding, *params = (part.strip().lower() for part in item.split(";"))
+            quality = next(
+                (param[2:] for param in params if param.startswith("q=")), "1"
+            )
+            try:
+                if float(quality) > 0:
+                    accepted.add(encoding)
+            except ValueError:
+                continue
+        if self.brotli is not None and "br" in accepted:
+            return self.brotli, "br"
+        if "gzip" in accepted:
+            return self.gzip, "gzip"
+        return self.body, None
+
+
+def css_revision(css: str) -> str:
+    return hashlib.sha256(css.encode()).hexdigest()[:16]
+
+
+async def build_theme_stylesheet(css: str) -> ThemeStylesheet:
+    """
+    Compress a theme once per revision, off the event loop. brotli at its best
+    quality takes a while for large themes.
+    """
+    revision = css_revision(css)
+    stylesheet = compressed_stylesheets.get(revision)
+    if not stylesheet:
+        stylesheet = await asyncio.to_thread(ThemeStylesheet, css)
+        compressed_stylesheets.set(revision, stylesheet)
+    return stylesheet
+
+
+# keyed by css_id, updates and deletes in `crud` drop the entry. the ttl bounds
+# how long other workers can serve an outdated theme
+theme_stylesheets: LRUCache[str, ThemeStylesheet] = LRUCache(maxsize=500, ttl=60)
+# keyed by revision, a revision never changes so a reload does not recompress
+compressed_stylesheets: LRUCache[str, ThemeStylesheet] = LRUCache(maxsize=500)
@@ -1,41 +1,162 @@
 import asyncio
 import time
+from typing import Optional
 
-from fastapi import WebSocket
 from lnbits.core.models import Payment
 from lnbits.settings import settings
-from lnbits.tasks import register_invoice_listener
+from lnbits.tasks import create_unique_task, register_invoice_listener
 from loguru import logger
 
+from .address_registry import address_registry
 from .crud import (
+    SETTINGS_CACHE_TTL,
+    delete_charge_transactions,
+    expire_overdue_charges,
     get_charge,
     get_charge_by_onchain_address,
+    get_charge_transactions,
+    get_or_create_satspay_settings,
     get_pending_charges,
-    update_charge,
+    update_charge_state,
+    upsert_charge_transactions,
 )
-from .helpers import call_webhook, check_charge_balance, sum_transactions
-from .models import Charge
-from .websocket_handler import ws_receive_queue, ws_send_queue
+from .expiry import expiry_scheduler
+from .helpers import (
+    check_charge_balance,
+    mark_settling_transaction,
+    mempool_budget,
+    parse_transactions,
+    reconcile_rate_limiter,
+)
+from .http_clients import start_http_clients
+from .keyed_pool import KeyedWorkerPool
+from .models import Charge, SatspaySettings
+from .notifications import publish_charge_update, restart_notification_task
+from .webhooks import enqueue_webhook
+from .websocket_handler import restart_websocket_task, ws_receive_queue
+
+ONCHAIN_WORKERS = 8
+SETTINGS_POLL_INTERVAL = SETTINGS_CACHE_TTL
+
+# only charges that expired this recently get a last balance check before they
+# are closed, older ones (e.g. after a long downtime) are just marked expired
+FINAL_BALANCE_CHECK_WINDOW = 60 * 60
+
 
-tracked_addresses: list[str] = []
-public_ws_listeners: dict[str, list[WebSocket]] = {}
+_applied_settings: Optional[SatspaySettings] = None
+
+
+def apply_satspay_settings(satspay_settings: SatspaySettings) -> None:
+    """
+    Restart everything that is set up from the settings.
+    """
+    global _applied_settings
+    _applied_settings = satspay_settings
+    create_unique_task("ext_satspay_http_clients", start_http_clients(satspay_settings))
+    restart_websocket_task()
+    restart_notification_task()
+
+
+async def wait_for_settings_changes():
+    """
+    Pick up settings that were changed through another worker.
+    """
+    global _applied_settings
+    if not _applied_settings:
+        _applied_settings = await get_or_create_satspay_settings()
+    while settings.lnbits_running:
+        await asyncio.sleep(SETTINGS_POLL_INTERVAL)
+        satspay_settings = await get_or_create_satspay_settings()
+        if satspay_settings != _applied_settings:
+            logger.info("Satspay settings were changed, applying them.")
+            apply_satspay_settings(satspay_settings)
 
 
 async def restart_address_tracking():
-    charges = await get_pending_charges()
+    started = time.time()
+    satspay_settings = await get_or_create_satspay_settings()
+
+    # charges that ran out long ago are closed in bulk, the rest is scheduled
+    stale_before = started - FINAL_BALANCE_CHECK_WINDOW
+    stale = await expire_overdue_charges(stale_before)
+    if stale:
+        logger.info(f"Marked {stale} stale charges as expired.")
+    charges = await get_pending_charges(expires_after=stale_before)
     for charge in charges:
-        if (
-            charge.onchainaddress
-            and charge.timestamp.timestamp() + charge.time * 60 > time.time()
-        ):
-            charge = await check_charge_balance(charge)
-            assert charge.onchainaddress
+        expiry_scheduler.schedule(charge)
+
+    # subscribe everything first so no payment goes unnoticed while reconciling
+    onchain_charges = [
+        charge
+        for charge in charges
+        if charge.onchainaddress and charge.expires_at > started
+    ]
+    address_registry.track_many(
+        charge.onchainaddress for charge in onchain_charges if charge.onchainaddress
+    )
+    total = len(onchain_charges)
+    logger.info(f"Tracking {len(address_registry)} addresses, reconciling {total}.")
+
+    concurrency = max(1, satspay_settings.reconcile_concurrency)
+    semaphore = asyncio.Semaphore(concurrency)
+    log_every = max(1, total // 10)
+    done = 0
+
+    async def _reconcile(charge: Charge):
+        nonlocal done
+        # only affects the task of this charge
+        mempool_budget.set(reconcile_rate_limiter)
+        async with semaphore:
+            try:
+                await _reconcile_charge(charge)
+            except Exception as exc:
+                logger.warning(f"Reconciling charge {charge.id} failed: {exc!s}")
+        done += 1
+        if done % log_every == 0 or done == total:
+            logger.info(f"Reconciled {done}/{total} charges.")
+
+    await asyncio.gather(*[_reconcile(charge) for charge in onchain_charges])
+    logger.info(
+        f"Address tracking restarted in {time.time() - started:.1f}s "
+        f"({total} charges, concurrency {concurrency})."
+    )
+
+
+async def _reconcile_charge(charge: Charge):
+    charge = await check_charge_balance(charge)
+    assert charge.onchainaddress
+    if charge.paid:
+        stop_onchain_listener(charge.onchainaddress)
+        expiry_scheduler.cancel(charge.id)
+        charge.add_extra({"payment_method": "onchain"})
+        await update_charge_state(charge)
+        logger.success(f"Charge {charge.id} marked as paid.")
+
+
+async def wait_for_expired_charges():
+    await expiry_scheduler.run(on_charge_expired)
+
+
+async def on_charge_expired(charge_id: str) -> None:
+    charge = await get_charge(charge_id)
+    if not charge or charge.paid or charge.expired:
+        return
+    if charge.onchainaddress:
+        stop_onchain_listener(charge.onchainaddress)
+        if time.time() - charge.expires_at < FINAL_BALANCE_CHECK_WINDOW:
+            # the merchant only hears about it if the charge turns out to be paid
+            charge = await check_charge_balance(charge, send_webhook=False)
             if charge.paid:
                 charge.add_extra({"payment_method": "onchain"})
-                await update_charge(charge)
-                logger.success(f"Charge {charge.id} marked as paid.")
-                continue
-            start_onchain_listener(charge.onchainaddress)
+                await send_success_websocket(charge)
+                await update_charge_state(charge)
+                if charge.webhook:
+                    await enqueue_webhook(charge)
+                logger.success(f"Charge {charge.id} paid on expiry.")
+                return
+    charge.expired = True
+    await update_charge_state(charge)
+    logger.info(f"Charge {charge.id} expired.")
 
 
 async def wait_for_paid_invoices():
@@ -48,19 +169,7 @@ async def wait_for_paid_invoices():
 
 
 async def send_success_websocket(charge: Charge):
-    for charge_id, listeners in public_ws_listeners.items():
-        if charge_id == charge.id:
-            for listener in listeners:
-                await listener.send_json(
-                    {
-                        "paid": charge.paid_fasttrack,
-                        "balance": charge.balance,
-                        "pending": charge.pending,
-                        "completelink": (
-                            charge.completelink if charge.paid_fasttrack else None
-                        ),
-                    }
-                )
+    await publish_charge_update(charge.id, charge.public_status)
 
 
 async def on_invoice_paid(payment: Payment) -> None:
@@ -79,46 +188,57 @@ async def on_invoice_paid(payment: Payment) -> None:
         charge.paid = True
         logger.success(f"Charge {charge.id} invoice paid.")
         charge.add_extra({"payment_method": "lightning"})
+        expiry_scheduler.cancel(charge.id)
         await send_success_websocket(charge)
+        await update_charge_state(charge)
         if charge.webhook:
-            resp = await call_webhook(charge)
-            charge.add_extra(resp)
-        await update_charge(charge)
+            await enqueue_webhook(charge)
 
 
 def start_onchain_listener(address: str):
-    if address in tracked_addresses:
-        return
-    tracked_addresses.append(address)
-    logger.debug(f"start_onchain_listener ({len(tracked_addresses)}")
-    ws_send_queue.put_nowait({"track-addresses": tracked_addresses})
+    if address_registry.track(address):
+        logger.debug(f"start_onchain_listener ({len(address_registry)})")
 
 
 def stop_onchain_listener(address: str):
-    if address in tracked_addresses:
-        tracked_addresses.remove(address)
-        logger.debug(f"stop_onchain_listener ({len(tracked_addresses)}")
-        ws_send_queue.put_nowait({"track-addresses": tracked_addresses})
+    if address_registry.untrack(address):
+        logger.debug(f"stop_onchain_listener ({len(address_registry)})")
 
 
 async def wait_for_onchain():
-    while settings.lnbits_running:
-        ws_message = await ws_receive_queue.get()
-        txs = ws_message.get("multi-address-transactions")
-        if not txs:
-            continue
-        for address, data in txs.items():
-            await _handle_ws_message(address, data)
+    pool_task = asyncio.create_task(onchain_pool.run())
+    try:
+        while settings.lnbits_running:
+            ws_message = await ws_receive_queue.get()
+            txs = ws_message.get("multi-address-transactions")
+            if not txs:
+                continue
+            for address, data in txs.items():
+                onchain_pool.submit(address, data)
+    finally:
+        pool_task.cancel()
 
 
 async def _handle_ws_message(address: str, data: dict):
     charge = await get_charge_by_onchain_address(address)
     assert charge, f"Charge with address `{address}` does not exist."
-    unconfirmed_balance = sum_transactions(address, data.get("mempool", []))
-    confirmed_balance = sum_transactions(address, data.get("confirmed", []))
-    unconfirmed_txids = [tx["txid"] for tx in data.get("mempool", [])]
-    confirmed_txids = [tx["txid"] for tx in data.get("confirmed", [])]
-    charge.add_extra({"txids": confirmed_txids + unconfirmed_txids})
+    # messages only carry what changed, the balance is summed over all known txs
+    await upsert_charge_transactions(
+        charge.id,
+        address,
+        [
+            *parse_transactions(address, data.get("confirmed", []), confirmed=True),
+            *parse_transactions(address, data.get("mempool", []), confirmed=False),
+        ],
+    )
+    removed_txids = [tx["txid"] for tx in data.get("removed", [])]
+    if removed_txids:
+        await delete_charge_transactions(charge.id, removed_txids)
+    transactions = await get_charge_transactions(charge.id)
+    confirmed_balance = sum(tx.value for tx in transactions if tx.status == "confirmed")
+    unconfirmed_balance = sum(
+        tx.value for tx in transactions if tx.status != "confirmed"
+    )
     if charge.zeroconf:
         confirmed_balance += unconfirmed_balance
     charge.balance = confirmed_balance
@@ -127,9 +247,14 @@ async def _handle_ws_message(address: str, data: dict):
     await send_success_websocket(charge)
     if charge.paid:
         charge.add_extra({"payment_method": "onchain"})
+        await mark_settling_transaction(charge)
         logger.success(f"Charge {charge.id} onchain paid.")
         stop_onchain_listener(address)
+        expiry_scheduler.cancel(charge.id)
+    await update_charge_state(charge)
     if charge.webhook:
-        resp = await call_webhook(charge)
-        charge.add_extra(resp)
-    await update_charge(charge)
+        await enqueue_webhook(charge)
+
+
+# addresses are handled concurrently, updates for one address stay in order
+onchain_pool = KeyedWorkerPool(_handle_ws_message, workers=ONCHAIN_WORKERS)
@@ -0,0 +1,89 @@
+"""
+Microbenchmark of the public charge projection, compared to building it from
+`Charge.dict()` as it used to be done. Run from the extensions directory:
+
+    python -m satspay.tests.benchmark_public_charge
+"""
+
+import json
+import timeit
+from datetime import datetime
+
+from ..models import Charge, PublicCharge
+
+PUBLIC_KEYS = [
+    "id",
+    "name",
+    "description",
+    "onchainaddress",
+    "payment_request",
+    "payment_hash",
+    "time",
+    "amount",
+    "zeroconf",
+    "fasttrack",
+    "balance",
+    "pending",
+    "timestamp",
+    "custom_css",
+    "paid",
+    "completelinktext",
+]
+
+
+def dict_projection(charge: Charge) -> dict:
+    c = {k: v for k, v in charge.dict().items() if k in PUBLIC_KEYS}
+    c["paid"] = charge.paid_fasttrack
+    c["timestamp"] = charge.timestamp.isoformat()
+    if charge.paid_fasttrack:
+        c["completelink"] = charge.completelink
+    return c
+
+
+def make_charge() -> Charge:
+    return Charge(
+        id="charge_id",
+        user="user_id",
+        amount=21000,
+        time=1440,
+        timestamp=datetime.now(),
+        name="order #1234",
+        description="a lot of coffee",
+        onchainwallet="onchainwallet_id",
+        onchainaddress="bc1qar0srrr7xfkvy5l643lydnw9re59gtzzwf5mdq",
+        lnbitswallet="wallet_id",
+        payment_request="lnbc210u1p" + "x" * 300,
+        payment_hash="f" * 64,
+        webhook="https://example.com/webhook",
+        completelink="https://example.com/thanks",
+        custom_css="theme_id",
+        extra=json.dumps({"webhook_response": "x" * 1000, "misc": list(range(50))}),
+    )
+
+
+def bench(name: str, fn, number: int = 20000) -> float:
+    per_call = min(timeit.repeat(fn, number=number, repeat=5)) / number * 1e6
+    print(f"{name:<40} {per_call:8.2f} µs/call")
+    return per_call
+
+
+def main():
+    charge = make_charge()
+    assert json.loads(PublicCharge.from_charge(charge).json()) == dict_projection(
+        charge
+    )
+    before = bench(
+        "dict() projection + json.dumps", lambda: json.dumps(dict_projection(charge))
+    )
+    bench(
+        "PublicCharge.from_charge().json()",
+        lambda: PublicCharge.from_charge(charge).json(),
+    )
+    after = bench(
+        "Charge.public_view.json() (memoized)", lambda: charge.public_view.json()
+    )
+    print(f"speedup: {before / after:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,24 @@
+import pytest
+import pytest_asyncio
+from lnbits.db import SQLITE, Database
+from lnbits.settings import settings
+
+from .. import crud, migrations
+
+
+@pytest_asyncio.fixture
+async def satspay_db(tmp_path, monkeypatch):
+    """
+    A fresh sqlite database with all migrations applied, used by the crud module.
+    """
+    monkeypatch.setattr(settings, "lnbits_data_folder", str(tmp_path))
+    db = Database("ext_satspay")
+    if db.type != SQLITE:
+        pytest.skip("database tests run on a throwaway sqlite database")
+    for name, migrate in vars(migrations).items():
+        if name.startswith("m0"):
+            await migrate(db)
+    monkeypatch.setattr(crud, "db", db)
+    crud.charge_cache.clear()
+    yield db
+    await db.engine.dispose()
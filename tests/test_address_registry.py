@@ -0,0 +1,92 @@
+from ..address_registry import AddressRegistry
+
+
+def _counts(registry: AddressRegistry) -> list[int]:
+    return [len(shard) for shard in registry.shards]
+
+
+def test_track_spreads_over_shards():
+    registry = AddressRegistry(shards=3, capacity=1000)
+    assert registry.track_many(["a", "b", "c", "a"]) == 3
+    assert _counts(registry) == [1, 1, 1]
+    assert "a" in registry
+    assert len(registry) == 3
+
+
+def test_track_single_empty_shard():
+    registry = AddressRegistry(shards=1, capacity=None)
+    registry.track_many(["a", "b", "c"])
+    assert _counts(registry) == [3]
+    assert registry.shards[0].has_changes
+
+
+def test_untrack():
+    registry = AddressRegistry(shards=2)
+    registry.track_many(["a", "b"])
+    assert registry.untrack("a")
+    assert not registry.untrack("a")
+    assert "a" not in registry
+    assert sum(_counts(registry)) == 1
+
+
+def test_capacity_is_exceeded_instead_of_dropping_addresses():
+    registry = AddressRegistry(shards=2, capacity=2)
+    registry.track_many(["a", "b", "c", "d", "e"])
+    assert len(registry) == 5
+    assert sorted(_counts(registry)) == [2, 3]
+    assert registry.over_capacity == 1
+
+
+def test_dead_shard_moves_addresses_to_live_shards():
+    registry = AddressRegistry(shards=2, capacity=10)
+    registry.track_many(["a", "b", "c", "d"])
+    dead, live = registry.shards
+    registry.mark_dead(dead)
+    assert _counts(registry) == [0, 4]
+    assert all(address in live for address in "abcd")
+
+    # new addresses avoid the dead shard until it is back
+    registry.track("e")
+    assert "e" in live
+    registry.mark_alive(dead)
+    registry.track("f")
+    assert "f" in dead
+
+
+def test_all_shards_dead_keeps_addresses():
+    registry = AddressRegistry(shards=1)
+    registry.track_many(["a", "b"])
+    shard = registry.shards[0]
+    registry.mark_dead(shard)
+    registry.track("c")
+    assert _counts(registry) == [3]
+    assert len(registry) == 3
+
+
+def test_reconnected_shard_takes_its_share_back():
+    registry = AddressRegistry(shards=2)
+    registry.track_many([f"address{i}" for i in range(10)])
+    dead, live = registry.shards
+    registry.mark_dead(dead)
+    assert _counts(registry) == [0, 10]
+
+    registry.mark_alive(dead)
+    assert _counts(registry) == [5, 5]
+    for address in dead.addresses:
+        assert address not in live
+
+
+def test_reconnected_shard_takes_addresses_of_dead_shards():
+    registry = AddressRegistry(shards=2)
+    registry.track_many(["a", "b", "c", "d"])
+    first, second = registry.shards
+    registry.mark_dead(first)
+    # nothing is left to move the addresses of the second shard to
+    registry.mark_dead(second)
+    assert _counts(registry) == [0, 4]
+
+    registry.mark_alive(first)
+    assert _counts(registry) == [4, 0]
+    registry.mark_alive(second)
+    assert _counts(registry) == [2, 2]
+    assert len(registry) == 4
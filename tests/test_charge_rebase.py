@@ -0,0 +1,108 @@
+import json
+from datetime import datetime
+
+import pytest
+
+from .. import crud
+from ..models import Charge
+
+
+def _charge(**kwargs) -> Charge:
+    values = {
+        "id": "charge_id",
+        "user": "user_id",
+        "amount": 1000,
+        "time": 60,
+        "timestamp": datetime(2024, 1, 1),
+        "version": 1,
+    }
+    values.update(kwargs)
+    return Charge(**values)
+
+
+def test_rebase_keeps_concurrent_extra_keys():
+    ours = _charge(extra=json.dumps({"a": 1}))
+    ours.add_extra({"webhook_success": True})
+
+    theirs = _charge(extra=json.dumps({"a": 1, "payment_method": "onchain"}))
+    theirs.version = 2
+    ours.rebase(theirs)
+
+    assert ours.version == 2
+    assert json.loads(ours.serialize_extra() or "{}") == {
+        "a": 1,
+        "payment_method": "onchain",
+        "webhook_success": True,
+    }
+
+
+def test_rebase_takes_latest_state_when_only_extra_changed():
+    ours = _charge()
+    ours.add_extra({"webhook_success": True})
+    theirs = _charge(balance=400, pending=600, version=2)
+    ours.rebase(theirs)
+    assert ours.state == theirs.state
+
+
+def test_rebase_keeps_our_state_changes():
+    ours = _charge()
+    ours.balance = 500
+    theirs = _charge(version=2, extra=json.dumps({"b": 2}))
+    ours.rebase(theirs)
+    assert ours.balance == 500
+    assert ours.extra_data == {"b": 2}
+
+
+def test_expiry_racing_with_payment_stays_paid():
+    # the expiry scheduler loaded the charge before the payment was written
+    expiring = _charge()
+    expiring.expired = True
+    paid = _charge(balance=1000, paid=True, version=2)
+    expiring.rebase(paid)
+    assert expiring.paid
+    assert not expiring.expired
+    assert expiring.balance == 1000
+
+
+def test_payment_racing_with_expiry_stays_paid():
+    # the payment was processed on a charge loaded before it was expired
+    paying = _charge()
+    paying.balance = 1000
+    paying.paid = True
+    expired = _charge(expired=True, version=2)
+    paying.rebase(expired)
+    assert paying.paid
+    assert not paying.expired
+    assert paying.version == 2
+
+
+class _Result:
+    def __init__(self, rowcount: int):
+        self.rowcount = rowcount
+
+
+@pytest.mark.asyncio
+async def test_update_charge_state_rebases_on_conflict(monkeypatch):
+    # a payment was written after the expiry scheduler loaded the charge
+    stored = _charge(balance=1000, paid=True, version=2)
+    writes: list[dict] = []
+
+    async def execute(_query: str, values: dict):
+        if values["version"] != stored.version:
+            return _Result(0)
+        writes.append(values)
+        return _Result(1)
+
+    async def get_charge(_charge_id: str):
+        return stored
+
+    monkeypatch.setattr(crud.db, "execute", execute)
+    monkeypatch.setattr(crud, "get_charge", get_charge)
+
+    expiring = _charge()
+    expiring.expired = True
+    charge = await crud.update_charge_state(expiring)
+
+    assert len(writes) == 1
+    assert writes[0]["paid"] and not writes[0]["expired"]
+    assert charge.version == 3
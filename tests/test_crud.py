@@ -0,0 +1,111 @@
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+from .. import crud
+from ..models import Charge, CreateCharge
+
+# one instant for all charges, so equal timestamps are tie-broken by id
+NOW = datetime.now()
+
+
+async def _create_charge(charge_id: str, created_ago: int = 0, **kwargs) -> Charge:
+    charge = Charge(
+        id=charge_id,
+        user="user_id",
+        amount=1000,
+        time=60,
+        timestamp=NOW - timedelta(minutes=created_ago),
+        **kwargs,
+    )
+    await crud.db.insert("satspay.charges", charge)
+    return charge
+
+
+@pytest.mark.asyncio
+async def test_pending_charges_are_bounded_by_expiry(satspay_db):
+    await _create_charge("running")
+    await _create_charge("overdue", created_ago=90)
+    await _create_charge("paid", paid=True)
+
+    pending = await crud.get_pending_charges(expires_after=time.time())
+    assert [charge.id for charge in pending] == ["running"]
+
+    pending = await crud.get_pending_charges(expires_after=time.time() - 3600)
+    assert sorted(charge.id for charge in pending) == ["overdue", "running"]
+
+
+@pytest.mark.asyncio
+async def test_overdue_charges_are_expired(satspay_db):
+    await _create_charge("running")
+    overdue = await _create_charge("overdue", created_ago=90)
+
+    assert await crud.expire_overdue_charges(time.time()) == 1
+    # already flagged charges are left alone
+    assert await crud.expire_overdue_charges(time.time()) == 0
+
+    expired = await crud.get_charge("overdue")
+    assert expired and expired.expired
+    assert expired.version == overdue.version + 1
+    running = await crud.get_charge("running")
+    assert running and not running.expired
+
+
+@pytest.mark.asyncio
+async def test_failed_invoice_does_not_fail_the_batch(satspay_db, monkeypatch):
+    async def create_invoice(**kwargs):
+        if kwargs["amount"] == 666:
+            raise ValueError("node offline")
+        return SimpleNamespace(payment_hash="hash", bolt11="lnbc")
+
+    monkeypatch.setattr(crud, "create_invoice", create_invoice)
+    charges_data = [
+        (
+            CreateCharge(lnbitswallet="wallet", description="", time=60, amount=amount),
+            None,
+            None,
+        )
+        for amount in (1000, 666, 2000)
+    ]
+
+    results = await crud.create_charges("user_id", charges_data)
+
+    assert isinstance(results[1], ValueError)
+    created = [result for result in results if isinstance(result, Charge)]
+    assert [charge.amount for charge in created] == [1000, 2000]
+    for charge in created:
+        assert await crud.get_charge(charge.id)
+
+
+@pytest.mark.asyncio
+async def test_charges_are_keyset_paginated(satspay_db):
+    # charges created in the same instant are ordered by id
+    for charge_id in ("a", "b", "c", "d", "e"):
+        await _create_charge(charge_id, created_ago=0 if charge_id < "d" else 5)
+
+    seen, cursor = [], None
+    while True:
+        page = await crud.get_charges_paginated("user_id", limit=2, cursor=cursor)
+        seen.extend(charge.id for charge in page.data)
+        cursor = page.next_cursor
+        if not cursor:
+            break
+    assert seen == ["c", "b", "a", "e", "d"]
+
+
+@pytest.mark.asyncio
+async def test_charge_search_escapes_like_wildcards(satspay_db):
+    await _create_charge("percent", name="50% off")
+    await _create_charge("digits", name="500 off")
+    await _create_charge("underscore", description="order_1")
+    await _create_charge("letter", description="orderx1")
+
+    async def search(term: str) -> list[str]:
+        page = await crud.get_charges_paginated("user_id", search=term)
+        return [charge.id for charge in page.data]
+
+    assert await search("50%") == ["percent"]
+    assert await search("ORDER_") == ["underscore"]
+    assert await search("\\") == []
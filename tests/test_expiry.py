@@ -0,0 +1,109 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+
+import pytest
+from lnbits.settings import settings
+
+from .. import crud, tasks
+from ..expiry import ExpiryScheduler
+from ..models import Charge
+
+
+def _charge(charge_id: str, expires_in: float, **kwargs) -> Charge:
+    return Charge(
+        id=charge_id,
+        user="user_id",
+        amount=1000,
+        time=1,
+        timestamp=datetime.now() + timedelta(seconds=expires_in - 60),
+        **kwargs,
+    )
+
+
+def test_due_charges_are_popped_in_expiry_order():
+    scheduler = ExpiryScheduler()
+    for charge_id, expires_in in (("late", 20), ("early", -20), ("now", -10)):
+        scheduler.schedule(_charge(charge_id, expires_in))
+    scheduler.cancel("now")
+
+    assert scheduler._pop_due(time.time()) == ["early"]
+    assert len(scheduler) == 1
+    assert scheduler._pop_due(time.time() + 30) == ["late"]
+    assert scheduler._next_deadline() is None
+
+
+def test_rescheduled_charge_expires_once():
+    scheduler = ExpiryScheduler()
+    charge = _charge("charge_id", -20)
+    scheduler.schedule(charge)
+    charge.time = 2
+    scheduler.schedule(charge)
+
+    assert scheduler._pop_due(time.time()) == []
+    assert scheduler._pop_due(time.time() + 60) == ["charge_id"]
+
+
+@pytest.mark.asyncio
+async def test_run_wakes_up_for_earlier_charges(monkeypatch):
+    monkeypatch.setattr(settings, "lnbits_running", True)
+    scheduler = ExpiryScheduler()
+    scheduler.schedule(_charge("late", 3600))
+    expired: list[str] = []
+
+    async def on_expired(charge_id: str):
+        expired.append(charge_id)
+        if charge_id == "failing":
+            raise ValueError("boom")
+
+    runner = asyncio.create_task(scheduler.run(on_expired))
+    await asyncio.sleep(0)
+    scheduler.schedule(_charge("failing", -1))
+    scheduler.schedule(_charge("soon", 0.05))
+    await asyncio.sleep(0.2)
+    runner.cancel()
+    await asyncio.gather(runner, return_exceptions=True)
+
+    assert expired == ["failing", "soon"]
+    assert len(scheduler) == 1
+
+
+@pytest.fixture
+def balance_checks(monkeypatch) -> list[bool]:
+    webhooks: list[bool] = []
+
+    async def check_charge_balance(charge: Charge, send_webhook: bool = True):
+        webhooks.append(send_webhook)
+        charge.balance = charge.amount if charge.description == "paid" else 0
+        charge.paid = charge.balance >= charge.amount
+        return charge
+
+    async def enqueue_webhook(charge: Charge):
+        webhooks.append(True)
+
+    monkeypatch.setattr(tasks, "check_charge_balance", check_charge_balance)
+    monkeypatch.setattr(tasks, "enqueue_webhook", enqueue_webhook)
+    return webhooks
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "description, paid, webhooks", [("paid", True, [False, True]), ("", False, [False])]
+)
+async def test_expired_charge_only_sends_webhook_when_paid(
+    satspay_db, balance_checks, description, paid, webhooks
+):
+    charge = _charge(
+        "charge_id",
+        -1,
+        description=description,
+        onchainaddress="address",
+        webhook="https://example.com/webhook",
+    )
+    await crud.db.insert("satspay.charges", charge)
+
+    await tasks.on_charge_expired(charge.id)
+
+    updated = await crud.get_charge(charge.id)
+    assert updated and updated.paid is paid and updated.expired is not paid
+    assert balance_checks == webhooks
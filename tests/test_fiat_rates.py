@@ -0,0 +1,26 @@
+import asyncio
+
+import pytest
+
+from .. import fiat_rates
+
+
+@pytest.mark.asyncio
+async def test_concurrent_refreshes_fetch_once(monkeypatch):
+    fetched: list[str] = []
+
+    async def get_fiat_rate_satoshis(currency: str) -> float:
+        fetched.append(currency)
+        await asyncio.sleep(0.01)
+        return 2500.0
+
+    monkeypatch.setattr(fiat_rates, "get_fiat_rate_satoshis", get_fiat_rate_satoshis)
+    cache = fiat_rates.FiatRateCache()
+
+    rates = await asyncio.gather(*[cache.refresh("EUR") for _ in range(5)])
+    assert {rate.rate for rate in rates} == {2500.0}
+    assert fetched == ["EUR"]
+
+    # a later refresh does fetch again
+    await cache.refresh("EUR")
+    assert fetched == ["EUR", "EUR"]
@@ -0,0 +1,32 @@
+import pytest
+
+from .. import helpers
+from ..models import SatspaySettings
+
+
+@pytest.mark.asyncio
+async def test_confirmed_transactions_are_cached_per_mempool(monkeypatch):
+    satspay_settings = SatspaySettings(mempool_url="https://mempool.space")
+    chains = {
+        "https://mempool.space": [{"txid": "main", "vout": []}],
+        "https://mempool.space/testnet": [{"txid": "test", "vout": []}],
+    }
+
+    async def get_settings():
+        return satspay_settings
+
+    async def mempool_get(url: str) -> list[dict]:
+        if url.endswith("/mempool"):
+            return []
+        return chains[url.split("/api/")[0]]
+
+    monkeypatch.setattr(helpers, "get_or_create_satspay_settings", get_settings)
+    monkeypatch.setattr(helpers, "_mempool_get", mempool_get)
+    helpers.confirmed_txs_cache.clear()
+
+    balance = await helpers._fetch_onchain_balance("address")
+    assert balance.txids == ["main"]
+
+    satspay_settings.mempool_url = "https://mempool.space/testnet"
+    balance = await helpers._fetch_onchain_balance("address")
+    assert balance.txids == ["test"]
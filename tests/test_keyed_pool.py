@@ -0,0 +1,86 @@
+import asyncio
+
+import pytest
+from lnbits.settings import settings
+
+from ..keyed_pool import KeyedWorkerPool
+
+
+@pytest.fixture
+def running(monkeypatch):
+    monkeypatch.setattr(settings, "lnbits_running", True)
+
+
+async def _drain(pool: KeyedWorkerPool) -> None:
+    runner = asyncio.create_task(pool.run())
+    for _ in range(100):
+        await asyncio.sleep(0.01)
+        if not pool.queue_depth and not pool._pending:
+            break
+    runner.cancel()
+    await asyncio.gather(runner, return_exceptions=True)
+
+
+@pytest.mark.asyncio
+async def test_jobs_of_a_key_run_in_order(running):
+    handled: list[tuple[str, int]] = []
+    running_keys: set[str] = set()
+    overlapped = False
+
+    async def handler(key: str, job: int):
+        nonlocal overlapped
+        overlapped = overlapped or key in running_keys
+        running_keys.add(key)
+        await asyncio.sleep(0.001 * (3 - job))
+        handled.append((key, job))
+        running_keys.discard(key)
+
+    pool = KeyedWorkerPool(handler, workers=4)
+    for job in range(3):
+        pool.submit("a", job)
+        pool.submit("b", job)
+    await _drain(pool)
+
+    assert not overlapped
+    assert [job for key, job in handled if key == "a"] == [0, 1, 2]
+    assert [job for key, job in handled if key == "b"] == [0, 1, 2]
+    assert pool.stats()["processed"] == 6
+
+
+@pytest.mark.asyncio
+async def test_keys_run_concurrently(running):
+    started = asyncio.Event()
+    release = asyncio.Event()
+
+    async def handler(key: str, _job: None):
+        if key == "slow":
+            started.set()
+            await release.wait()
+        else:
+            release.set()
+
+    pool = KeyedWorkerPool(handler, workers=2)
+    pool.submit("slow", None)
+    pool.submit("fast", None)
+    # the fast key is handled while the slow one is still waiting
+    await asyncio.wait_for(_drain(pool), timeout=1)
+    assert started.is_set()
+    assert pool.processed == 2
+
+
+@pytest.mark.asyncio
+async def test_failed_job_does_not_stop_its_key(running):
+    handled: list[int] = []
+
+    async def handler(_key: str, job: int):
+        if job == 0:
+            raise ValueError("boom")
+        handled.append(job)
+
+    pool = KeyedWorkerPool(handler, workers=1)
+    pool.submit("a", 0)
+    pool.submit("a", 1)
+    await _drain(pool)
+
+    assert handled == [1]
+    assert (pool.processed, pool.failed) == (1, 1)
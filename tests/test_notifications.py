@@ -0,0 +1,62 @@
+import pytest
+
+from .. import crud, notifications
+from ..models import SatspaySettings
+
+
+async def _insert_notification(notification_id: int, origin: str = "other"):
+    await crud.db.execute(
+        """
+        INSERT INTO satspay.notifications (id, origin, charge_id, payload)
+        VALUES (:id, :origin, :charge_id, '{}')
+        """,
+        {"id": notification_id, "origin": origin, "charge_id": f"charge_{origin}"},
+    )
+
+
+@pytest.fixture
+def relayed(monkeypatch) -> list[str]:
+    relayed: list[str] = []
+    monkeypatch.setattr(
+        notifications.public_listeners,
+        "notify",
+        lambda charge_id, _message: relayed.append(charge_id),
+    )
+    return relayed
+
+
+@pytest.mark.asyncio
+async def test_late_commits_are_relayed(satspay_db, relayed):
+    bus = notifications.DatabaseNotificationBus()
+    await _insert_notification(1)
+    await _insert_notification(2, origin=bus.origin)
+    # id 3 was handed out first but its transaction commits later
+    await _insert_notification(4)
+
+    await bus.poll()
+    assert relayed == ["charge_other", "charge_other"]
+    assert list(bus.missing_ids) == [3]
+
+    await _insert_notification(3)
+    await bus.poll()
+    await bus.poll()
+    assert len(relayed) == 3
+    assert bus.missing_ids == {}
+
+
+@pytest.mark.asyncio
+async def test_rolled_back_ids_are_given_up(satspay_db, relayed, monkeypatch):
+    bus = notifications.DatabaseNotificationBus()
+    await _insert_notification(2)
+    await bus.poll()
+    assert list(bus.missing_ids) == [1]
+
+    monkeypatch.setattr(notifications, "NOTIFICATION_GAP_TIMEOUT", -1)
+    await bus.poll()
+    assert bus.missing_ids == {}
+    assert relayed == ["charge_other"]
+
+
+def test_notification_backend_is_validated():
+    with pytest.raises(ValueError):
+        SatspaySettings(notification_backend="redis")
@@ -0,0 +1,69 @@
+import asyncio
+
+import pytest
+
+from ..throttle import SingleFlight, TokenBucket
+
+original_sleep = asyncio.sleep
+
+
+@pytest.mark.asyncio
+async def test_single_flight_coalesces_calls():
+    calls = 0
+
+    async def fetch():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return calls
+
+    flight: SingleFlight[int] = SingleFlight(ttl=5)
+    results = await asyncio.gather(*[flight.do("key", fetch) for _ in range(5)])
+    assert results == [1] * 5
+    assert calls == 1
+
+
+@pytest.mark.asyncio
+async def test_single_flight_survives_cancelled_leader():
+    started = asyncio.Event()
+
+    async def fetch():
+        started.set()
+        await asyncio.sleep(0.01)
+        return "result"
+
+    flight: SingleFlight[str] = SingleFlight(ttl=5)
+    leader = asyncio.create_task(flight.do("key", fetch))
+    await started.wait()
+    follower = asyncio.create_task(flight.do("key", fetch))
+    await asyncio.sleep(0)
+    leader.cancel()
+
+    assert await follower == "result"
+    with pytest.raises(asyncio.CancelledError):
+        await leader
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_reserves_tokens_in_order(monkeypatch):
+    bucket = TokenBucket(rate=10)
+    bucket.tokens = 0
+    sleeps: list[float] = []
+
+    async def sleep(delay: float):
+        sleeps.append(round(delay, 2))
+        await asyncio.Event().wait()
+
+    monkeypatch.setattr(asyncio, "sleep", sleep)
+    waiters = [asyncio.create_task(bucket.acquire()) for _ in range(3)]
+    await original_sleep(0)
+    # every caller reserved its own token without waiting for the others
+    assert sleeps == [0.1, 0.2, 0.3]
+
+    waiters[2].cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiters[2]
+    assert round(bucket.tokens, 1) == -2
+    for waiter in waiters[:2]:
+        waiter.cancel()
+    await asyncio.gather(*waiters, return_exceptions=True)
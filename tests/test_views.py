@@ -0,0 +1,134 @@
+import time
+from datetime import datetime
+
+import httpx
+import pytest
+from fastapi import FastAPI
+from fastapi.responses import HTMLResponse
+
+from .. import crud, views
+from ..models import Charge, CreateSatsPayTheme
+from ..stylesheets import ThemeStylesheet
+
+
+class _Renderer:
+    def __init__(self):
+        self.rendered = 0
+
+    def TemplateResponse(  # noqa: N802
+        self, _template: str, context: dict, headers: dict
+    ):
+        self.rendered += 1
+        return HTMLResponse(content=context["charge_data"], headers=headers)
+
+
+@pytest.fixture
+def renderer(monkeypatch):
+    renderer = _Renderer()
+    monkeypatch.setattr(views, "satspay_renderer", lambda: renderer)
+    views.rendered_charge_pages.clear()
+    return renderer
+
+
+async def _get(path: str, **headers) -> httpx.Response:
+    app = FastAPI()
+    app.include_router(views.satspay_generic_router)
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as c:
+        return await c.get(path, headers=headers)
+
+
+async def _create_charge() -> Charge:
+    charge = Charge(
+        id="charge_id",
+        user="user_id",
+        amount=1000,
+        time=60,
+        timestamp=datetime.now(),
+    )
+    await crud.db.insert("satspay.charges", charge)
+    return charge
+
+
+def test_etag_matches():
+    etag = '"abc"'
+    assert views._etag_matches('"abc"', etag)
+    assert views._etag_matches('W/"abc"', etag)
+    assert views._etag_matches('"x", W/"abc"', etag)
+    assert views._etag_matches(" * ", etag)
+    assert not views._etag_matches("", etag)
+    assert not views._etag_matches('"abcd"', etag)
+    assert not views._etag_matches('"xabc", "abc1"', etag)
+
+
+@pytest.mark.asyncio
+async def test_charge_page_is_revalidated(satspay_db, renderer):
+    await _create_charge()
+
+    response = await _get("/charge_id")
+    assert response.status_code == 200
+    etag = response.headers["etag"]
+
+    response = await _get("/charge_id", **{"If-None-Match": f'"other", W/{etag}'})
+    assert response.status_code == 304
+    assert renderer.rendered == 1
+
+    # the expiry scheduler closed the charge, the cached copy is outdated
+    await crud.expire_overdue_charges(time.time() + 2 * 3600)
+    response = await _get("/charge_id", **{"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+    assert renderer.rendered == 2
+
+
+@pytest.mark.asyncio
+async def test_final_charge_page_is_rendered_once(satspay_db, renderer, monkeypatch):
+    await _create_charge()
+    await crud.expire_overdue_charges(time.time() + 2 * 3600)
+
+    first = await _get("/charge_id")
+    second = await _get("/charge_id")
+    assert first.text == second.text
+    assert renderer.rendered == 1
+
+    # a changed site title is shown on the page
+    monkeypatch.setattr(views.settings, "lnbits_site_title", "Another title")
+    third = await _get("/charge_id")
+    assert third.headers["etag"] != first.headers["etag"]
+    assert renderer.rendered == 2
+
+
+def test_stylesheet_encoding_honours_q0():
+    stylesheet = ThemeStylesheet("body { color: red; }")
+    assert stylesheet.encode_for("gzip, br;q=0")[1] == "gzip"
+    assert stylesheet.encode_for("gzip;q=0, identity") == (stylesheet.body, None)
+    assert stylesheet.encode_for("gzip;q=0.5")[1] == "gzip"
+    assert stylesheet.encode_for("gzip;q=oops")[1] is None
+
+
+@pytest.mark.asyncio
+async def test_stylesheet_etag_depends_on_encoding(satspay_db):
+    theme = await crud.create_theme(
+        CreateSatsPayTheme(title="theme", custom_css="body { color: red; }"),
+        "user_id",
+    )
+    path = f"/css/{theme.css_id}"
+
+    gzipped = await _get(path, **{"Accept-Encoding": "gzip"})
+    plain = await _get(path, **{"Accept-Encoding": "identity"})
+    assert gzipped.headers["content-encoding"] == "gzip"
+    assert gzipped.headers["etag"] != plain.headers["etag"]
+
+    # a cached plain copy must not be revalidated for a gzip client
+    response = await _get(
+        path,
+        **{"Accept-Encoding": "gzip", "If-None-Match": plain.headers["etag"]},
+    )
+    assert response.status_code == 200
+
+    response = await _get(
+        path,
+        **{"Accept-Encoding": "gzip", "If-None-Match": gzipped.headers["etag"]},
+    )
+    assert response.status_code == 304
+    assert response.headers["vary"] == "Accept-Encoding"
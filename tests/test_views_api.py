@@ -0,0 +1,97 @@
+import json
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from fastapi import FastAPI
+from lnbits.decorators import require_admin_key
+
+from .. import crud, views_api
+from ..models import Charge
+
+
+@pytest.fixture
+def checked(monkeypatch):
+    """
+    Balance checks pay every charge named `paid*`, webhooks are recorded.
+    """
+    webhooks: list[str] = []
+
+    async def check_charge_balance(charge: Charge, send_webhook: bool = True):
+        assert not send_webhook
+        if charge.id.startswith("paid"):
+            charge.balance = charge.amount
+            charge.paid = True
+        return charge
+
+    async def enqueue_webhook(charge: Charge):
+        webhooks.append(charge.id)
+
+    monkeypatch.setattr(views_api, "check_charge_balance", check_charge_balance)
+    monkeypatch.setattr(views_api, "enqueue_webhook", enqueue_webhook)
+    return webhooks
+
+
+async def _create_charges(*charge_ids: str) -> None:
+    now = datetime.now()
+    for n, charge_id in enumerate(charge_ids):
+        charge = Charge(
+            id=charge_id,
+            user="user_id",
+            amount=1000,
+            time=60,
+            timestamp=now - timedelta(minutes=n),
+            webhook="https://example.com/webhook",
+        )
+        await crud.db.insert("satspay.charges", charge)
+
+
+async def _check_balances(data: dict) -> list[dict]:
+    app = FastAPI()
+    app.include_router(views_api.satspay_api_router)
+    app.dependency_overrides[require_admin_key] = lambda: SimpleNamespace(
+        wallet=SimpleNamespace(user="user_id")
+    )
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as c:
+        response = await c.put("/api/v1/charges/balance", json=data)
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    return [json.loads(line) for line in response.text.splitlines()]
+
+
+@pytest.mark.asyncio
+async def test_bulk_balance_check_streams_saved_results(satspay_db, checked):
+    await _create_charges("paid1", "unpaid1", "paid2")
+
+    *results, summary = await _check_balances(
+        {"charge_ids": ["paid1", "unpaid1", "paid2", "unknown"]}
+    )
+
+    assert {r["charge_id"]: r["changed"] for r in results} == {
+        "paid1": True,
+        "unpaid1": False,
+        "paid2": True,
+    }
+    assert summary == {"checked": 3, "updated": 2, "truncated": False}
+    assert sorted(checked) == ["paid1", "paid2"]
+    for charge_id in ("paid1", "paid2"):
+        charge = await crud.get_charge(charge_id)
+        assert charge and charge.paid and charge.balance == 1000
+    unpaid = await crud.get_charge("unpaid1")
+    assert unpaid and not unpaid.paid
+
+
+@pytest.mark.asyncio
+async def test_bulk_balance_check_reports_truncation(satspay_db, checked, monkeypatch):
+    monkeypatch.setattr(views_api, "BALANCE_CHECK_LIMIT", 2)
+    monkeypatch.setattr(views_api, "BALANCE_CHECK_WRITE_BATCH", 1)
+    await _create_charges("new", "older", "oldest")
+
+    *results, summary = await _check_balances(
+        {"created_after": (datetime.now() - timedelta(days=1)).isoformat()}
+    )
+
+    assert sorted(r["charge_id"] for r in results) == ["new", "older"]
+    assert summary == {"checked": 2, "updated": 0, "truncated": True}
@@ -0,0 +1,127 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from .. import crud, webhooks
+from ..models import Charge
+
+
+async def _create_delivery(
+    charge_id: str = "charge_id",
+    webhook: str = "https://example.com/webhook",
+    due_since: int = 2,
+):
+    charge = Charge(
+        id=charge_id,
+        user="user_id",
+        amount=1000,
+        time=60,
+        timestamp=datetime.now(),
+        webhook=webhook,
+    )
+    await crud.db.insert("satspay.charges", charge)
+    delivery = await crud.create_webhook_delivery(charge)
+    # `next_attempt_at` is compared with whole seconds
+    delivery.next_attempt_at = datetime.now() - timedelta(seconds=due_since)
+    return await crud.update_webhook_delivery(delivery)
+
+
+def _take_queued() -> list[str]:
+    queued = []
+    while not webhooks.webhook_queue.empty():
+        queued.append(webhooks.webhook_queue.get_nowait().id)
+    webhooks._in_flight.clear()
+    webhooks._in_flight_hosts.clear()
+    return queued
+
+
+@pytest.mark.asyncio
+async def test_delivery_is_claimed_once(satspay_db):
+    delivery = await _create_delivery()
+
+    assert await crud.claim_webhook_delivery(delivery.id, lease=60)
+    # another worker polled the same pending row
+    assert not await crud.claim_webhook_delivery(delivery.id, lease=60)
+    assert await crud.get_due_webhook_deliveries() == []
+
+    claimed = await crud.get_webhook_delivery(delivery.id)
+    assert claimed and claimed.status == "sending"
+
+
+@pytest.mark.asyncio
+async def test_expired_claims_are_released(satspay_db):
+    delivery = await _create_delivery()
+    # the worker holding the claim died while sending
+    assert await crud.claim_webhook_delivery(delivery.id, lease=-1)
+
+    await crud.release_expired_webhook_claims()
+
+    assert [d.id for d in await crud.get_due_webhook_deliveries()] == [delivery.id]
+    assert await crud.claim_webhook_delivery(delivery.id, lease=60)
+
+
+@pytest.mark.asyncio
+async def test_claim_due_webhooks_queues_each_delivery_once(satspay_db):
+    first = await _create_delivery("first")
+    second = await _create_delivery("second")
+
+    await webhooks.claim_due_webhooks()
+    await webhooks.claim_due_webhooks()
+
+    assert sorted(_take_queued()) == sorted([first.id, second.id])
+
+
+@pytest.mark.asyncio
+async def test_busy_host_does_not_hold_back_other_hosts(satspay_db):
+    # a large backlog of one merchant that became due before anything else
+    slow = [
+        await _create_delivery(f"slow{i}", "https://slow.example/hook", due_since=60)
+        for i in range(3 * webhooks.WEBHOOK_MAX_CLAIMED)
+    ]
+    other = await _create_delivery("other", "https://OTHER.example/hook")
+    assert other.host == "other.example"
+
+    await webhooks.claim_due_webhooks()
+
+    queued = _take_queued()
+    assert other.id in queued
+    assert len(set(queued) & {d.id for d in slow}) == webhooks.WEBHOOK_MAX_PER_HOST
+
+
+@pytest.mark.asyncio
+async def test_failed_delivery_is_retried_then_given_up(satspay_db, monkeypatch):
+    async def call_webhook(_delivery):
+        return {"webhook_success": False, "webhook_message": "Bad Gateway"}
+
+    monkeypatch.setattr(webhooks, "call_webhook", call_webhook)
+    delivery = await _create_delivery()
+    assert await crud.claim_webhook_delivery(delivery.id, lease=60)
+
+    await webhooks.deliver_webhook(delivery)
+    retry = await crud.get_webhook_delivery(delivery.id)
+    assert retry and retry.status == "pending" and retry.attempts == 1
+    assert retry.next_attempt_at.timestamp() > datetime.now().timestamp()
+    assert retry.claimed_until is None
+
+    retry.attempts = webhooks.WEBHOOK_MAX_ATTEMPTS - 1
+    await webhooks.deliver_webhook(retry)
+    failed = await crud.get_webhook_delivery(delivery.id)
+    assert failed and failed.status == "failed"
+
+    charge = await crud.get_charge(delivery.charge_id)
+    assert charge and charge.extra_data["webhook_message"] == "Bad Gateway"
+
+
+@pytest.mark.asyncio
+async def test_finished_deliveries_are_pruned(satspay_db):
+    delivered = await _create_delivery("delivered")
+    delivered.status = "delivered"
+    await crud.update_webhook_delivery(delivered)
+    pending = await _create_delivery("pending")
+
+    await crud.delete_webhook_deliveries(before=datetime.now().timestamp() + 10)
+    assert await crud.get_webhook_delivery(delivered.id) is None
+    assert await crud.get_webhook_delivery(pending.id)
+
+    await crud.delete_charge(pending.charge_id)
+    assert await crud.get_webhook_delivery(pending.id) is None
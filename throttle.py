@@ -0,0 +1,102 @@
+import asyncio
+import time
+from collections.abc import Awaitable
+from typing import Callable, Generic, TypeVar
+
+from .cache import LRUCache
+
+T = TypeVar("T")
+
+
+class TokenBucket:
+    """
+    Allows `rate` calls per second on average, with bursts of up to `rate` calls.
+    Callers reserve a token in arrival order and wait for it without blocking
+    the callers behind them.
+    """
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = float(rate)
+        self._updated = time.monotonic()
+
+    def configure(self, rate: float) -> None:
+        if rate == self.rate:
+            return
+        self._refill()
+        self.rate = rate
+        self.tokens = min(self.tokens, rate)
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self) -> None:
+        if self.rate <= 0:
+            # rate limiting disabled
+            return
+        # no await until the token is taken, so no lock is needed. tokens go
+        # negative while callers wait for reserved ones
+        self._refill()
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return
+        try:
+            await asyncio.sleep(-self.tokens / self.rate)
+        except asyncio.CancelledError:
+            # hand the reserved token back
+            self.tokens += 1
+            raise
+
+
+class _CallerCancelledError(Exception):
+    pass
+
+
+class SingleFlight(Generic[T]):
+    """
+    Runs at most one call per key at a time, concurrent callers for the same key
+    share its result. Results are also kept for `ttl` seconds afterwards.
+    """
+
+    def __init__(self, ttl: float, maxsize: int = 10000):
+        self._calls: dict[str, asyncio.Future[T]] = {}
+        self._results: LRUCache[str, T] = LRUCache(maxsize=maxsize, ttl=ttl)
+
+    def forget(self, key: str) -> None:
+        self._results.pop(key)
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[T]]) -> T:
+        while True:
+            result = self._results.get(key)
+            if result is not None:
+                return result
+            call = self._calls.get(key)
+            if call is None:
+                break
+            try:
+                return await asyncio.shield(call)
+            except _CallerCancelledError:
+                # the caller running the call went away, the next one takes over
+                continue
+
+        call = asyncio.get_running_loop().create_future()
+        self._calls[key] = call
+        try:
+            result = await fn()
+            self._results.set(key, result)
+            call.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            # only the cancelled caller is cancelled, the others retry
+            call.set_exception(_CallerCancelledError())
+            call.exception()
+            raise
+        except Exception as exc:
+            call.set_exception(exc)
+            # only the callers waiting on this call see the error
+            call.exception()
+            raise
+        finally:
+            del self._calls[key]
@@ -1,5 +1,7 @@
-import json
+import hashlib
+import re
 from http import HTTPStatus
+from typing import Optional
 
 from fastapi import (
     APIRouter,
@@ -8,7 +10,6 @@ from fastapi import (
     Request,
     Response,
     WebSocket,
-    WebSocketDisconnect,
 )
 from fastapi.responses import HTMLResponse
 from lnbits.core.models import User
@@ -16,11 +17,35 @@ from lnbits.decorators import check_user_exists
 from lnbits.helpers import template_renderer
 from lnbits.settings import settings
 
-from .crud import get_charge, get_or_create_satspay_settings, get_theme
-from .tasks import public_ws_listeners
+from .cache import LRUCache
+from .crud import get_charge_cached, get_or_create_satspay_settings, get_theme
+from .listeners import PublicListener, public_listeners
+from .models import Charge
+from .stylesheets import ThemeStylesheet, build_theme_stylesheet, theme_stylesheets
 
 satspay_generic_router = APIRouter()
 
+# rendered checkout pages of paid and expired charges, keyed by their ETag
+rendered_charge_pages: LRUCache[str, bytes] = LRUCache(maxsize=500, ttl=60 * 60)
+
+# LNbits settings that show up on the checkout page, part of its ETag
+SITE_SETTINGS = (
+    "lnbits_site_title",
+    "lnbits_site_tagline",
+    "lnbits_site_description",
+    "lnbits_custom_logo",
+    "lnbits_custom_badge",
+    "lnbits_custom_badge_color",
+    "lnbits_theme_options",
+    "lnbits_qr_logo",
+    "lnbits_denomination",
+    "lnbits_ad_space_enabled",
+    "lnbits_ad_space",
+    "lnbits_ad_space_title",
+)
+
+_ENTITY_TAG = re.compile(r'(?:W/)?"[^"]*"')
+
 
 def satspay_renderer():
     return template_renderer(["satspay/templates"])
@@ -28,61 +53,125 @@ def satspay_renderer():
 
 @satspay_generic_router.get("/", response_class=HTMLResponse)
 async def index(request: Request, user: User = Depends(check_user_exists)):
-    settings = await get_or_create_satspay_settings()
+    satspay_settings = await get_or_create_satspay_settings()
     return satspay_renderer().TemplateResponse(
         "satspay/index.html",
         {
             "request": request,
             "user": user.json(),
             "admin": user.admin,
-            "network": settings.network,
+            "network": satspay_settings.network,
         },
     )
 
 
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    """
+    Weak comparison of an `If-None-Match` header with a list of (weak) ETags
+    or `*`.
+    """
+    if if_none_match.strip() == "*":
+        return True
+    return any(
+        tag.removeprefix("W/") == etag for tag in _ENTITY_TAG.findall(if_none_match)
+    )
+
+
+def _charge_page_etag(
+    charge: Charge, mempool_url: str, stylesheet: Optional[ThemeStylesheet]
+) -> str:
+    # every write of a charge bumps its version
+    site = [getattr(settings, name, None) for name in SITE_SETTINGS]
+    page_state = (
+        f"{charge.id}:{charge.version}:{mempool_url}:"
+        f"{stylesheet.revision if stylesheet else ''}:{settings.version}:{site!r}"
+    )
+    return f'"{hashlib.sha256(page_state.encode()).hexdigest()[:16]}"'
+
+
 @satspay_generic_router.get("/{charge_id}", response_class=HTMLResponse)
 async def display_charge(request: Request, charge_id: str):
-    charge = await get_charge(charge_id)
+    charge = await get_charge_cached(charge_id)
     if not charge:
         raise HTTPException(
             status_code=HTTPStatus.NOT_FOUND, detail="Charge link does not exist."
         )
-    settings = await get_or_create_satspay_settings()
-    return satspay_renderer().TemplateResponse(
+    satspay_settings = await get_or_create_satspay_settings()
+    stylesheet = (
+        await get_theme_stylesheet(charge.custom_css) if charge.custom_css else None
+    )
+    etag = _charge_page_etag(charge, satspay_settings.mempool_url, stylesheet)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if _etag_matches(request.headers.get("if-none-match", ""), etag):
+        return Response(status_code=HTTPStatus.NOT_MODIFIED, headers=headers)
+
+    page = rendered_charge_pages.get(etag)
+    if page:
+        return HTMLResponse(content=page, headers=headers)
+    response = satspay_renderer().TemplateResponse(
         "satspay/display.html",
         {
             "request": request,
-            "charge_data": json.dumps(charge.public),
+            "charge_data": charge.public_view.json(),
             "custom_css": charge.custom_css,
-            "mempool_url": settings.mempool_url,
+            "custom_css_revision": stylesheet.revision if stylesheet else None,
+            "mempool_url": satspay_settings.mempool_url,
         },
+        headers=headers,
     )
+    # paid and expired charges do not change anymore, keep their page around
+    if charge.paid or charge.expired:
+        rendered_charge_pages.set(etag, bytes(response.body))
+    return response
 
 
 @satspay_generic_router.websocket("/{charge_id}/ws")
 async def websocket_charge(websocket: WebSocket, charge_id: str):
-    charge = await get_charge(charge_id)
+    charge = await get_charge_cached(charge_id)
     if not charge:
         raise HTTPException(
             status_code=HTTPStatus.NOT_FOUND, detail="Charge link does not exist."
         )
     await websocket.accept()
-    if charge_id not in public_ws_listeners:
-        public_ws_listeners[charge_id] = []
-    public_ws_listeners[charge_id].append(websocket)
+    listener = PublicListener(websocket)
+    public_listeners.add(charge_id, listener)
     try:
-        # Keep the connection alive
-        while settings.lnbits_running:
-            await websocket.receive_text()
-    except WebSocketDisconnect:
-        for ws in public_ws_listeners.get(charge_id, []):
-            if ws == websocket:
-                public_ws_listeners[charge_id].remove(ws)
+        await listener.run()
+    finally:
+        public_listeners.remove(charge_id, listener)
 
 
-@satspay_generic_router.get("/css/{css_id}")
-async def display_css(css_id: str):
+async def get_theme_stylesheet(css_id: str) -> Optional[ThemeStylesheet]:
+    stylesheet = theme_stylesheets.get(css_id)
+    if stylesheet:
+        return stylesheet
     theme = await get_theme(css_id)
-    if theme:
-        return Response(content=theme.custom_css, media_type="text/css")
-    return None
+    if not theme:
+        return None
+    stylesheet = await build_theme_stylesheet(theme.custom_css)
+    theme_stylesheets.set(css_id, stylesheet)
+    return stylesheet
+
+
+@satspay_generic_router.get("/css/{css_id}")
+async def display_css(request: Request, css_id: str, v: Optional[str] = None):
+    stylesheet = await get_theme_stylesheet(css_id)
+    if not stylesheet:
+        return None
+    body, encoding = stylesheet.encode_for(request.headers.get("accept-encoding", ""))
+    etag = stylesheet.etag_for(encoding)
+    headers = {
+        "ETag": etag,
+        "Vary": "Accept-Encoding",
+        # a versioned url never changes, the theme gets a new one when it is edited
+        "Cache-Control": (
+            "public, max-age=31536000, immutable"
+            if v == stylesheet.revision
+            else "public, no-cache"
+        ),
+    }
+    if _etag_matches(request.headers.get("if-none-match", ""), etag):
+        return Response(status_code=HTTPStatus.NOT_MODIFIED, headers=headers)
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, media_type="text/css", headers=headers)
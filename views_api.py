@@ -1,6 +1,12 @@
+import asyncio
+import json
+from collections.abc import AsyncGenerator
+from datetime import datetime
 from http import HTTPStatus
+from typing import Optional
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import StreamingResponse
 from lnbits.core.crud import get_wallet
 from lnbits.core.models import Wallet, WalletTypeInfo
 from lnbits.decorators import (
@@ -8,31 +14,62 @@ from lnbits.decorators import (
     require_admin_key,
     require_invoice_key,
 )
-from lnbits.utils.exchange_rates import get_fiat_rate_satoshis
 from loguru import logger
 
+from .address_pool import address_pool
+from .address_registry import address_registry
 from .crud import (
     create_charge,
+    create_charges,
     delete_charge,
     delete_satspay_settings,
     get_charge,
+    get_charge_cached,
+    get_charge_transactions,
     get_charges,
+    get_charges_paginated,
     get_or_create_satspay_settings,
-    update_charge,
+    get_unpaid_charges,
+    update_charge_state,
+    update_charges_state,
     update_satspay_settings,
 )
+from .expiry import expiry_scheduler
+from .fiat_rates import fiat_rates
 from .helpers import (
-    call_webhook,
     check_charge_balance,
-    fetch_onchain_address,
     fetch_onchain_config_network,
 )
-from .models import Charge, CreateCharge, SatspaySettings
-from .tasks import start_onchain_listener, stop_onchain_listener
-from .websocket_handler import restart_websocket_task
+from .listeners import public_listeners
+from .models import (
+    Charge,
+    ChargeBalanceCheck,
+    ChargesPage,
+    ChargeTransaction,
+    CheckChargesBalance,
+    CreateCharge,
+    CreateChargeResult,
+    CreateCharges,
+    FiatRate,
+    SatspaySettings,
+)
+from .tasks import (
+    apply_satspay_settings,
+    onchain_pool,
+    start_onchain_listener,
+    stop_onchain_listener,
+)
+from .webhooks import enqueue_webhook
 
 satspay_api_router = APIRouter()
 
+# parallel invoice and address requests when creating charges in bulk
+BATCH_CONCURRENCY = 10
+# checked charges written per transaction by the bulk balance check
+BALANCE_CHECK_WRITE_BATCH = 50
+# charges checked per bulk balance check request, the newest first
+BALANCE_CHECK_LIMIT = 1000
+
 
 async def _get_wallet_network(wallet: Wallet) -> str:
     try:
@@ -51,60 +88,148 @@ async def api_enabled() -> dict:
     return {"message": "SatsPay API enabled."}
 
 
-@satspay_api_router.post("/api/v1/charge")
-async def api_charge_create(
-    data: CreateCharge, key_type: WalletTypeInfo = Depends(require_invoice_key)
-) -> Charge:
+async def _validate_charge(
+    data: CreateCharge,
+    user: str,
+    wallets: Optional[dict[str, Optional[Wallet]]] = None,
+) -> Optional[FiatRate]:
+    """
+    Check a new charge and convert its fiat amount, returns the rate used.
+    `wallets` caches the wallet lookups when validating many charges.
+    """
+    wallets = {} if wallets is None else wallets
+    fiat_rate = None
     if not data.amount and not data.currency_amount:
         raise HTTPException(
             status_code=HTTPStatus.BAD_REQUEST,
             detail="either amount or currency_amount are required.",
         )
     if data.currency and data.currency_amount:
-        rate = await get_fiat_rate_satoshis(data.currency)
-        data.amount = round(rate * data.currency_amount)
+        fiat_rate = await fiat_rates.get(data.currency)
+        data.amount = round(fiat_rate.rate * data.currency_amount)
     if not data.onchainwallet and not data.lnbitswallet:
         raise HTTPException(
             status_code=HTTPStatus.BAD_REQUEST,
             detail="either onchainwallet or lnbitswallet are required.",
         )
     if data.lnbitswallet:
-        lnbitswallet = await get_wallet(data.lnbitswallet)
+        if data.lnbitswallet not in wallets:
+            wallets[data.lnbitswallet] = await get_wallet(data.lnbitswallet)
+        lnbitswallet = wallets[data.lnbitswallet]
         if not lnbitswallet:
             raise HTTPException(
                 status_code=HTTPStatus.BAD_REQUEST,
                 detail="LNbits wallet does not exist.",
             )
-        if lnbitswallet.user != key_type.wallet.user:
+        if lnbitswallet.user != user:
             raise HTTPException(
                 status_code=HTTPStatus.BAD_REQUEST,
                 detail="LNbits wallet does not belong to you.",
             )
+    return fiat_rate
+
+
+async def _check_wallet_network(wallet: Wallet) -> None:
+    settings = await get_or_create_satspay_settings()
+    network = await _get_wallet_network(wallet)
+    if network != settings.network:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST,
+            detail=f"Onchain network mismatch. {network} != {settings.network}",
+        )
+
+
+@satspay_api_router.post("/api/v1/charge")
+async def api_charge_create(
+    data: CreateCharge, key_type: WalletTypeInfo = Depends(require_invoice_key)
+) -> Charge:
+    fiat_rate = await _validate_charge(data, key_type.wallet.user)
     if data.onchainwallet:
-        settings = await get_or_create_satspay_settings()
-        network = await _get_wallet_network(key_type.wallet)
-        if network != settings.network:
-            raise HTTPException(
-                status_code=HTTPStatus.BAD_REQUEST,
-                detail=f"Onchain network mismatch. {network} != {settings.network}",
-            )
+        await _check_wallet_network(key_type.wallet)
         try:
-            new_address = await fetch_onchain_address(
-                data.onchainwallet, key_type.wallet.inkey
+            new_address = await address_pool.take(
+                data.onchainwallet, key_type.wallet.user, key_type.wallet.inkey
             )
             start_onchain_listener(new_address)
-            return await create_charge(
+            charge = await create_charge(
                 user=key_type.wallet.user,
                 onchainaddress=new_address,
                 data=data,
+                fiat_rate=fiat_rate,
             )
+            expiry_scheduler.schedule(charge)
+            return charge
         except Exception as exc:
             logger.error(f"Error fetching onchain config: {exc}")
             raise HTTPException(
                 status_code=HTTPStatus.BAD_REQUEST,
                 detail="Error fetching onchain address.",
             ) from exc
-    return await create_charge(user=key_type.wallet.user, data=data)
+    charge = await create_charge(
+        user=key_type.wallet.user, data=data, fiat_rate=fiat_rate
+    )
+    expiry_scheduler.schedule(charge)
+    return charge
+
+
+@satspay_api_router.post("/api/v1/charges/batch")
+async def api_charges_create_batch(
+    data: CreateCharges, key_type: WalletTypeInfo = Depends(require_invoice_key)
+) -> list[CreateChargeResult]:
+    """
+    Create many charges at once. Every item of the response holds either the
+    created charge or the error of the charge at the same position.
+    """
+    wallets: dict[str, Optional[Wallet]] = {}
+    fiat_rates_used = [
+        await _validate_charge(charge_data, key_type.wallet.user, wallets)
+        for charge_data in data.charges
+    ]
+    if any(charge_data.onchainwallet for charge_data in data.charges):
+        await _check_wallet_network(key_type.wallet)
+
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def _fetch_address(charge_data: CreateCharge) -> Optional[str]:
+        if not charge_data.onchainwallet:
+            return None
+        async with semaphore:
+            return await address_pool.take(
+                charge_data.onchainwallet, key_type.wallet.user, key_type.wallet.inkey
+            )
+
+    try:
+        addresses = await asyncio.gather(
+            *[_fetch_address(charge_data) for charge_data in data.charges]
+        )
+    except Exception as exc:
+        logger.error(f"Error fetching onchain address: {exc}")
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST,
+            detail="Error fetching onchain address.",
+        ) from exc
+    results = await create_charges(
+        key_type.wallet.user,
+        list(zip(data.charges, addresses, fiat_rates_used)),
+        concurrency=BATCH_CONCURRENCY,
+    )
+    charges = [charge for charge in results if isinstance(charge, Charge)]
+    address_registry.track_many(
+        charge.onchainaddress for charge in charges if charge.onchainaddress
+    )
+    for charge in charges:
+        expiry_scheduler.schedule(charge)
+    failed = len(results) - len(charges)
+    if failed:
+        logger.warning(f"Creating {failed} of {len(results)} charges failed.")
+    return [
+        (
+            CreateChargeResult(charge=result)
+            if isinstance(result, Charge)
+            else CreateChargeResult(error=f"Error creating charge: {result!s}")
+        )
+        for result in results
+    ]
 
 
 @satspay_api_router.get("/api/v1/charges")
@@ -114,6 +239,34 @@ async def api_charges_retrieve(
     return await get_charges(wallet.wallet.user)
 
 
+@satspay_api_router.get("/api/v1/charges/paginated")
+async def api_charges_retrieve_paginated(
+    limit: int = Query(50, ge=1, le=500),
+    cursor: Optional[str] = None,
+    status: Optional[str] = Query(None, regex="^(paid|pending|expired)$"),
+    wallet: Optional[str] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    search: Optional[str] = None,
+    key_info: WalletTypeInfo = Depends(require_admin_key),
+) -> ChargesPage:
+    try:
+        return await get_charges_paginated(
+            key_info.wallet.user,
+            limit=limit,
+            cursor=cursor,
+            status=status,
+            wallet=wallet,
+            date_from=date_from,
+            date_to=date_to,
+            search=search,
+        )
+    except ValueError as exc:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST, detail=str(exc)
+        ) from exc
+
+
 @satspay_api_router.get(
     "/api/v1/charge/{charge_id}", dependencies=[Depends(require_invoice_key)]
 )
@@ -129,7 +282,7 @@ async def api_charge_retrieve(charge_id: str) -> Charge:
     useful if the webhook is not working or fails for some reason.
     https://github.com/lnbits/woocommerce-payment-gateway/blob/main/lnbits.php#L312
     """
-    charge = await get_charge(charge_id)
+    charge = await get_charge_cached(charge_id)
     if not charge:
         raise HTTPException(
             status_code=HTTPStatus.NOT_FOUND, detail="Charge does not exist."
@@ -137,6 +290,14 @@ async def api_charge_retrieve(charge_id: str) -> Charge:
     return charge
 
 
+@satspay_api_router.get(
+    "/api/v1/charge/{charge_id}/transactions",
+    dependencies=[Depends(require_invoice_key)],
+)
+async def api_charge_transactions(charge_id: str) -> list[ChargeTransaction]:
+    return await get_charge_transactions(charge_id)
+
+
 @satspay_api_router.put(
     "/api/v1/charge/balance/{charge_id}", dependencies=[Depends(require_admin_key)]
 )
@@ -154,10 +315,104 @@ async def api_charge_check_balance(charge_id: str) -> Charge:
     pending_before = charge.pending
     charge = await check_charge_balance(charge)
     if charge.balance != balance_before or charge.pending != pending_before:
-        charge = await update_charge(charge)
+        charge = await update_charge_state(charge)
+    if charge.paid:
+        expiry_scheduler.cancel(charge.id)
     return charge
 
 
+async def _save_checked_charges(changed: list[Charge]) -> None:
+    await update_charges_state(changed)
+    for charge in changed:
+        if charge.webhook:
+            await enqueue_webhook(charge)
+        if charge.paid:
+            expiry_scheduler.cancel(charge.id)
+            if charge.onchainaddress:
+                stop_onchain_listener(charge.onchainaddress)
+
+
+async def _check_charges_balance(
+    charges: list[Charge], truncated: bool = False
+) -> AsyncGenerator[str, None]:
+    satspay_settings = await get_or_create_satspay_settings()
+    semaphore = asyncio.Semaphore(max(1, satspay_settings.reconcile_concurrency))
+
+    async def _check(charge: Charge) -> tuple[Charge, ChargeBalanceCheck]:
+        async with semaphore:
+            state_before = charge.state
+            try:
+                charge = await check_charge_balance(charge, send_webhook=False)
+            except Exception as exc:
+                return charge, ChargeBalanceCheck(charge_id=charge.id, error=str(exc))
+        return charge, ChargeBalanceCheck(
+            charge_id=charge.id,
+            balance=charge.balance,
+            pending=charge.pending,
+            paid=charge.paid,
+            changed=charge.state != state_before,
+        )
+
+    tasks = [asyncio.create_task(_check(charge)) for charge in charges]
+    # results are reported once their changes are written, in batches
+    results: list[ChargeBalanceCheck] = []
+    changed: list[Charge] = []
+    updated = 0
+    try:
+        for n, next_done in enumerate(asyncio.as_completed(tasks), start=1):
+            charge, result = await next_done
+            results.append(result)
+            if result.changed:
+                changed.append(charge)
+            if len(results) < BALANCE_CHECK_WRITE_BATCH and n < len(tasks):
+                continue
+            await _save_checked_charges(changed)
+            updated += len(changed)
+            changed = []
+            yield "".join(result.json() + "\n" for result in results)
+            results = []
+    finally:
+        for task in tasks:
+            task.cancel()
+        # a client that went away early still gets the finished checks saved. the
+        # response is being cancelled then, the shield lets the save run to the end
+        await asyncio.shield(_save_checked_charges(changed))
+    yield json.dumps(
+        {"checked": len(charges), "updated": updated, "truncated": truncated}
+    ) + "\n"
+
+
+@satspay_api_router.put("/api/v1/charges/balance")
+async def api_charges_check_balance(
+    data: CheckChargesBalance,
+    key_info: WalletTypeInfo = Depends(require_admin_key),
+) -> StreamingResponse:
+    """
+    Check the balance of many unpaid charges, selected by id and/or creation date.
+    Results are streamed as newline delimited json, one line per charge once its
+    changes are saved, followed by a summary line. Webhooks are only sent for
+    charges whose payment state changed. At most `BALANCE_CHECK_LIMIT` charges
+    are checked, the newest first, `truncated` in the summary tells if there
+    were more.
+    """
+    if data.charge_ids is None and data.created_after is None:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST,
+            detail="either charge_ids or created_after are required.",
+        )
+    charges = await get_unpaid_charges(
+        key_info.wallet.user,
+        charge_ids=data.charge_ids,
+        created_after=data.created_after,
+        limit=BALANCE_CHECK_LIMIT + 1,
+    )
+    truncated = len(charges) > BALANCE_CHECK_LIMIT
+    return StreamingResponse(
+        _check_charges_balance(charges[:BALANCE_CHECK_LIMIT], truncated),
+        media_type="application/x-ndjson",
+    )
+
+
 @satspay_api_router.get(
     "/api/v1/charge/webhook/{charge_id}", dependencies=[Depends(require_admin_key)]
 )
@@ -171,9 +426,7 @@ async def api_charge_webhook(charge_id: str) -> Charge:
         raise HTTPException(
             status_code=HTTPStatus.BAD_REQUEST, detail="No webhook set."
         )
-    resp = await call_webhook(charge)
-    charge.add_extra(resp)
-    charge = await update_charge(charge)
+    await enqueue_webhook(charge)
     return charge
 
 
@@ -188,10 +441,26 @@ async def api_charge_delete(charge_id: str):
         )
     if charge.onchainaddress:
         stop_onchain_listener(charge.onchainaddress)
+    expiry_scheduler.cancel(charge_id)
 
     await delete_charge(charge_id)
 
 
+@satspay_api_router.get("/api/v1/stats", dependencies=[Depends(check_admin)])
+async def api_get_stats() -> dict:
+    return {
+        "onchain": onchain_pool.stats(),
+        "tracked_addresses": len(address_registry),
+        "addresses_over_capacity": address_registry.over_capacity,
+        "websocket_shards": [
+            {"name": shard.name, "alive": shard.alive, "addresses": len(shard)}
+            for shard in address_registry.shards
+        ],
+        "scheduled_expiries": len(expiry_scheduler),
+        "public_listeners": len(public_listeners),
+    }
+
+
 @satspay_api_router.get("/api/v1/settings", dependencies=[Depends(check_admin)])
 async def api_get_or_create_settings() -> SatspaySettings:
     return await get_or_create_satspay_settings()
@@ -200,11 +469,11 @@ async def api_get_or_create_settings() -> SatspaySettings:
 @satspay_api_router.put("/api/v1/settings", dependencies=[Depends(check_admin)])
 async def api_update_settings(data: SatspaySettings) -> SatspaySettings:
     settings = await update_satspay_settings(data)
-    restart_websocket_task()
+    apply_satspay_settings(settings)
     return settings
 
 
 @satspay_api_router.delete("/api/v1/settings", dependencies=[Depends(check_admin)])
 async def api_delete_settings() -> None:
     await delete_satspay_settings()
-    restart_websocket_task()
+    apply_satspay_settings(await get_or_create_satspay_settings())
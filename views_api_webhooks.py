@@ -0,0 +1,42 @@
+from datetime import datetime
+from http import HTTPStatus
+from typing import Optional
+
+from fastapi import APIRouter, Depends, HTTPException
+from lnbits.decorators import check_admin
+
+from .crud import get_webhook_deliveries, get_webhook_delivery, update_webhook_delivery
+from .models import WebhookDelivery
+from .webhooks import wake_webhook_dispatcher
+
+satspay_webhook_router = APIRouter()
+
+
+@satspay_webhook_router.get("/api/v1/webhooks", dependencies=[Depends(check_admin)])
+async def api_get_webhook_deliveries(
+    charge_id: Optional[str] = None,
+    status: Optional[str] = None,
+    limit: int = 100,
+) -> list[WebhookDelivery]:
+    return await get_webhook_deliveries(charge_id, status, min(limit, 1000))
+
+
+@satspay_webhook_router.put(
+    "/api/v1/webhooks/{delivery_id}/redrive", dependencies=[Depends(check_admin)]
+)
+async def api_redrive_webhook_delivery(delivery_id: str) -> WebhookDelivery:
+    delivery = await get_webhook_delivery(delivery_id)
+    if not delivery:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND, detail="Webhook delivery does not exist."
+        )
+    if delivery.status in ("pending", "sending"):
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST, detail="Delivery is already pending."
+        )
+    delivery.status = "pending"
+    delivery.attempts = 0
+    delivery.next_attempt_at = datetime.now()
+    await update_webhook_delivery(delivery)
+    wake_webhook_dispatcher()
+    return delivery
@@ -0,0 +1,183 @@
+import asyncio
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+from lnbits.settings import settings
+from loguru import logger
+
+from .crud import (
+    claim_webhook_delivery,
+    create_webhook_delivery,
+    delete_webhook_deliveries,
+    get_charge,
+    get_due_webhook_deliveries,
+    get_or_create_satspay_settings,
+    release_expired_webhook_claims,
+    update_charge_state,
+    update_webhook_delivery,
+)
+from .http_clients import WEBHOOK, get_http_client
+from .models import Charge, WebhookDelivery
+
+WEBHOOK_WORKERS = 4
+WEBHOOK_MAX_ATTEMPTS = 8
+WEBHOOK_RETRY_BASE_DELAY = 30
+WEBHOOK_POLL_INTERVAL = 10
+# deliveries to the same host at once, so one slow merchant can not take up every
+# worker and connection of the webhook pool
+WEBHOOK_MAX_PER_HOST = 2
+# deliveries claimed by this worker at once, so claims do not wait long in the queue
+WEBHOOK_MAX_CLAIMED = 2 * WEBHOOK_WORKERS
+# a claimed delivery goes back to all workers if it is not finished by then
+WEBHOOK_CLAIM_LEASE = 5 * 60
+# delivered and failed deliveries are kept this long for the webhooks api
+WEBHOOK_RETENTION = 7 * 24 * 60 * 60
+WEBHOOK_CLEANUP_INTERVAL = 60 * 60
+# merchant responses end up in the charge `extra`, keep them from piling up
+WEBHOOK_RESPONSE_LIMIT = 1000
+
+webhook_queue: asyncio.Queue[WebhookDelivery] = asyncio.Queue()
+# deliveries claimed by this worker, queued or being sent
+_in_flight: set[str] = set()
+_in_flight_hosts: Counter[str] = Counter()
+_wakeup = asyncio.Event()
+
+
+async def enqueue_webhook(charge: Charge) -> WebhookDelivery:
+    """
+    Store a webhook delivery in the outbox, the workers pick it up right away.
+    """
+    delivery = await create_webhook_delivery(charge)
+    _wakeup.set()
+    return delivery
+
+
+def wake_webhook_dispatcher() -> None:
+    _wakeup.set()
+
+
+async def call_webhook(delivery: WebhookDelivery) -> dict:
+    try:
+        satspay_settings = await get_or_create_satspay_settings()
+        client = get_http_client(WEBHOOK)
+        # wordpress expect a GET request with json_encoded binary content
+        if satspay_settings.webhook_method == "GET":
+            r = await client.request(
+                method="GET",
+                url=delivery.url,
+                content=delivery.payload,
+            )
+        else:
+            r = await client.post(
+                url=delivery.url,
+                json=delivery.payload,
+            )
+        if r.is_success:
+            logger.success(f"Webhook sent for charge {delivery.charge_id}")
+        else:
+            logger.warning(f"Failed to call webhook for charge {delivery.charge_id}")
+            logger.warning(delivery.url)
+            logger.warning(r.text)
+        return {
+            "webhook_success": r.is_success,
+            "webhook_message": r.reason_phrase,
+            "webhook_response": r.text[:WEBHOOK_RESPONSE_LIMIT],
+        }
+    except Exception as e:
+        logger.warning(f"Failed to call webhook for charge {delivery.charge_id}")
+        logger.warning(e)
+        return {
+            "webhook_success": False,
+            "webhook_message": str(e)[:WEBHOOK_RESPONSE_LIMIT],
+        }
+
+
+async def deliver_webhook(delivery: WebhookDelivery) -> WebhookDelivery:
+    resp = await call_webhook(delivery)
+    delivery.attempts += 1
+    delivery.last_message = resp.get("webhook_message")
+    delivery.last_response = resp.get("webhook_response")
+    delivery.claimed_until = None
+    if resp["webhook_success"]:
+        delivery.status = "delivered"
+    elif delivery.attempts >= WEBHOOK_MAX_ATTEMPTS:
+        delivery.status = "failed"
+    else:
+        delivery.status = "pending"
+        delay = WEBHOOK_RETRY_BASE_DELAY * 2 ** (delivery.attempts - 1)
+        delivery.next_attempt_at = datetime.now() + timedelta(seconds=delay)
+    await update_webhook_delivery(delivery)
+
+    # keep the last result on the charge, it is shown in the charges table
+    charge = await get_charge(delivery.charge_id)
+    if charge:
+        charge.add_extra(resp)
+        await update_charge_state(charge)
+    return delivery
+
+
+async def claim_due_webhooks() -> None:
+    """
+    Queue due deliveries for the workers of this process. Every delivery is claimed
+    first, so with several LNbits workers each webhook is still sent only once.
+    """
+    await release_expired_webhook_claims()
+    while True:
+        free = WEBHOOK_MAX_CLAIMED - len(_in_flight)
+        if free <= 0:
+            return
+        # hosts that are busy are left out in the query, so their backlog can not
+        # hide the deliveries of other hosts
+        saturated = [
+            host
+            for host, count in _in_flight_hosts.items()
+            if count >= WEBHOOK_MAX_PER_HOST
+        ]
+        deliveries = await get_due_webhook_deliveries(free, saturated)
+        if not deliveries:
+            return
+        for delivery in deliveries:
+            if _in_flight_hosts[delivery.host] >= WEBHOOK_MAX_PER_HOST:
+                # busy since the query, excluded from the next one
+                continue
+            if not await claim_webhook_delivery(delivery.id, WEBHOOK_CLAIM_LEASE):
+                # claimed by another worker in the meantime
+                continue
+            delivery.status = "sending"
+            _in_flight.add(delivery.id)
+            _in_flight_hosts[delivery.host] += 1
+            webhook_queue.put_nowait(delivery)
+        if len(deliveries) < free:
+            # that was everything that is due
+            return
+
+
+async def dispatch_webhooks():
+    last_cleanup = 0.0
+    while settings.lnbits_running:
+        _wakeup.clear()
+        await claim_due_webhooks()
+        if time.time() - last_cleanup > WEBHOOK_CLEANUP_INTERVAL:
+            await delete_webhook_deliveries(time.time() - WEBHOOK_RETENTION)
+            last_cleanup = time.time()
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout=WEBHOOK_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def webhook_worker():
+    while settings.lnbits_running:
+        delivery = await webhook_queue.get()
+        try:
+            await deliver_webhook(delivery)
+        except Exception as exc:
+            logger.warning(f"Webhook delivery {delivery.id} failed: {exc!s}")
+        finally:
+            _in_flight.discard(delivery.id)
+            _in_flight_hosts[delivery.host] -= 1
+            if _in_flight_hosts[delivery.host] <= 0:
+                del _in_flight_hosts[delivery.host]
+            # there is room for the next claim
+            _wakeup.set()
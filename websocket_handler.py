@@ -7,10 +7,10 @@ from lnbits.tasks import create_permanent_unique_task
 from loguru import logger
 from websockets.client import connect
 
+from .address_registry import AddressSubscription, address_registry
 from .crud import get_or_create_satspay_settings
 
 ws_receive_queue: asyncio.Queue[dict] = asyncio.Queue()
-ws_send_queue: asyncio.Queue[dict] = asyncio.Queue()
 
 websocket_task: Optional[asyncio.Task] = None
 
@@ -31,26 +31,58 @@ async def consumer_handler(websocket):
         ws_receive_queue.put_nowait(json.loads(message))
 
 
-async def producer_handler(websocket):
+async def producer_handler(websocket, subscription: AddressSubscription):
+    # a new connection does not know about any addresses yet
+    subscription.resync()
     while settings.lnbits_running:
-        message = json.dumps(await ws_send_queue.get())
+        addresses = await subscription.next_frame()
+        message = json.dumps({"track-addresses": addresses})
         logger.debug(f"Send message: {message[:69]}...")
         await websocket.send(message)
 
 
+async def websocket_shard_handler(uri: str, shard: AddressSubscription):
+    retry_delay = 1
+    while settings.lnbits_running:
+        try:
+            async with connect(uri) as websocket:
+                logger.info(f"websocket_handler: {shard.name} connected to {uri}")
+                address_registry.mark_alive(shard)
+                retry_delay = 1
+                consumer_task = asyncio.create_task(consumer_handler(websocket))
+                producer_task = asyncio.create_task(producer_handler(websocket, shard))
+                done, pending = await asyncio.wait(
+                    [consumer_task, producer_task],
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                for task in pending:
+                    task.cancel()
+                for task in done:
+                    task.result()
+            logger.warning(f"websocket_handler: {shard.name} connection closed.")
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            logger.warning(f"websocket_handler: {shard.name} failed with: {exc!s}")
+        address_registry.mark_dead(shard)
+        await asyncio.sleep(retry_delay)
+        retry_delay = min(retry_delay * 2, 60)
+
+
 async def websocket_handler():
     satspay_settings = await get_or_create_satspay_settings()
     uri = f"{satspay_settings.mempool_url}/api/v1/ws".replace("http", "ws")
-    logger.info(f"websocket_handler: Connecting to {uri}...")
-    async with connect(uri) as websocket:
-        logger.info(f"websocket_handler: Connected to {uri}")
-        consumer_task = asyncio.create_task(consumer_handler(websocket))
-        producer_task = asyncio.create_task(producer_handler(websocket))
-        _, pending = await asyncio.wait(
-            [consumer_task, producer_task],
-            return_when=asyncio.FIRST_COMPLETED,
-        )
-        for task in pending:
-            task.cancel()
+    address_registry.configure(
+        satspay_settings.websocket_shards,
+        # 0 means no capacity limit
+        satspay_settings.addresses_per_shard or None,
+    )
+    logger.info(
+        f"websocket_handler: Connecting {len(address_registry.shards)} "
+        f"shards to {uri}..."
+    )
+    await asyncio.gather(
+        *[websocket_shard_handler(uri, shard) for shard in address_registry.shards]
+    )
 
     raise Exception("websocket_handler unexpectedly finished")